@@ -1,22 +1,97 @@
 '''Cell class and helper functions'''
-from typing import Optional, Tuple
+from typing import Optional
 import re
 from decimal import Decimal
+from types import MappingProxyType
+# The location helpers live in cell_address; they are imported from here too
+from .cell_address import get_cell_tuple, get_cell_name, get_location, \
+    pack_location, unpack_location
+
+# Marks a formula tree that has not been parsed yet
+_UNPARSED = object()
+
+# The (empty) dependency sets of cells that have none. It is shared by all
+# those cells, and read-only so that edges are added with add_child.
+NO_CELLS = MappingProxyType({})
 
 class Cell:
-    ''' Represents a cell in a sheets'''
+    ''' Represents a cell in a sheets. Cells are kept small, since sheets
+        have many of them: there is no __dict__, constant cells only store
+        their contents and value (Cell(contents) returns a FormulaCell for
+        formulas), and the sets of the dependency graph are only created
+        for cells that have edges.'''
+    __slots__ = ("contents", "value", "children", "parents", "bad_parents")
+
+    # determines if the cell is a formula or not
+    is_formula = False
+    # Formula cells have a parse tree and a compiled formula
+    tree = None
+    formula = None
+
+    def __new__(cls, contents = None):
+        if cls is Cell and contents is not None and contents.strip()[:1] == "=":
+            cls = FormulaCell
+        return object.__new__(cls)
+
     def __init__(self, contents = None):
         if contents == "":
             contents = None
         # remove whitespace
         self.contents = contents.strip() if contents is not None else None
         self.value = None
-        # determines if the cell is a formula or not
-        self.is_formula = self.contents[0] == \
-            "=" if self.contents is not None else False
-        self.children = [] # List of cell names that depend on cell
-        self.parents = [] # List of cell names that current cell depends on
-        self.bad_parents = []
+        # The dependency graph: (sheet, cell) tuples of the cells that depend
+        # on this cell, that this cell depends on, and that it depends on in
+        # nonexistent sheets. Dicts with None values are used as ordered
+        # sets, so edges are added and removed in O(1) and iteration order
+        # is deterministic.
+        self.children = NO_CELLS
+        self.parents = NO_CELLS
+        self.bad_parents = NO_CELLS
+
+    def add_child(self, key):
+        '''Adds a (sheet, cell) to the cells that depend on this cell'''
+        if self.children is NO_CELLS:
+            self.children = {}
+        self.children[key] = None
+
+    def remove_child(self, key):
+        '''Removes a (sheet, cell) from the cells that depend on this cell'''
+        if key in self.children:
+            del self.children[key]
+
+
+class FormulaCell(Cell):
+    ''' A cell with a formula'''
+    __slots__ = ("_tree", "formula")
+
+    is_formula = True
+
+    def __init__(self, contents = None):
+        super().__init__(contents)
+        # Parsed formula tree, built on first use and then reused by every
+        # move, rename and sort (see the tree property)
+        self._tree = _UNPARSED
+        # Compiled formula bound to the cell's location (formula_compiler)
+        self.formula = None
+
+    @property
+    def tree(self):
+        ''' The parse tree of the formula, or None if the formula does not
+            parse. Evaluation does not need the tree, so it is only parsed
+            when it is asked for.'''
+        if self._tree is _UNPARSED:
+            self._tree = None
+            import lark
+            from .formula_grammar import parser
+            try:
+                self._tree = parser.parse(self.contents)
+            except lark.exceptions.LarkError:
+                pass
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree):
+        self._tree = tree
 
 
 def parse_cell_contents(contents: Optional[str]):
@@ -48,49 +123,3 @@ def parse_cell_contents(contents: Optional[str]):
     if re.match("^-?\\d*(\\.\\d+)?$", contents) is not None:
         return Decimal('{:f}'.format(Decimal(contents).normalize()))
     return contents
-
-## Helper functions for cell operations
-def get_cell_tuple(location: str) -> Tuple[int, int]:
-    '''Converts cell location string to tuple
-     Throws ValueError if cell location is invalid'''
-
-    # Split string in to letters and numbers
-    location = location.lower()
-    if " " in location:
-        raise ValueError("Invalid cell format.")
-
-    match = re.match(r"([a-z]+)([0-9]+$)", location, re.I)
-    if not match:
-        raise ValueError("Invalid cell format.")
-
-    (col, row) = match.groups()
-    if row[0] == "0":
-        raise ValueError("Invalid cell format.")
-    row = int(row)
-
-    #Must convert column string (base 26) to integer
-    alph = "abcdefghijklmnopqrstuvwxyz"  # or string.ascii_uppercase
-    alph_index = {char: ind for ind, char in enumerate(alph, 1)}
-    result = 0
-    for char in col.lower():
-        result = result * 26 + alph_index[char]
-    col = result
-
-    # Check validity
-    if col < 1 or col > 475254 or row < 1 or row > 9999:
-        raise ValueError("Cell location must be within A1 and ZZZZ9999.")
-
-    return (col, row)
-
-## Helper functions for cell operations
-def get_cell_name(loc: Tuple[int, int]) -> str:
-    '''Converts cell tuple to location string'''
-    col, row = loc
-    if col < 1 or row < 1:
-        raise ValueError("Invalid location tuple: {}".format(loc))
-    #must convert the column to letter value:
-    loc_string = ""
-    while col > 0:
-        col, rem = divmod(col - 1, 26)
-        loc_string = chr(65 + rem) + loc_string
-    return loc_string + str(row)
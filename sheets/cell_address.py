@@ -0,0 +1,99 @@
+'''Conversions between cell locations ("A12") and (col, row) tuples'''
+from typing import Tuple
+from functools import lru_cache
+from itertools import product
+import re
+
+# The valid area of a sheet is A1:ZZZZ9999
+MAX_COL = 475254
+MAX_ROW = 9999
+
+# Column names of up to 3 letters (A..ZZZ) are precomputed in both
+# directions. Longer names are one division or multiplication away.
+_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_COLUMN_NAMES = [""] # column number -> uppercase name
+for _length in range(1, 4):
+    _COLUMN_NAMES.extend("".join(chars) for chars in product(_LETTERS, repeat = _length))
+_COLUMN_NAMES_LOWER = [name.lower() for name in _COLUMN_NAMES]
+_COLUMN_NUMBERS = {name: col for col, name in enumerate(_COLUMN_NAMES_LOWER)}
+del _COLUMN_NUMBERS[""]
+_TABLE_MAX = len(_COLUMN_NAMES) - 1 # ZZZ
+
+_LOCATION = re.compile(r"([a-z]+)([0-9]+$)", re.I)
+
+# Number of recently parsed locations kept by get_cell_tuple
+ADDRESS_CACHE_SIZE = 1 << 14
+
+
+def column_number(letters: str) -> int:
+    '''Converts column letters (any case, any length) to a column number'''
+    letters = letters.lower()
+    col = _COLUMN_NUMBERS.get(letters)
+    if col is None:
+        col = _COLUMN_NUMBERS[letters[:3]]
+        for char in letters[3:]:
+            col = col * 26 + ord(char) - 96
+    return col
+
+
+def column_name(col: int, lower: bool = False) -> str:
+    '''Converts a column number to its letters. Columns before A are ""'''
+    if col <= _TABLE_MAX:
+        names = _COLUMN_NAMES_LOWER if lower else _COLUMN_NAMES
+        return names[col] if col > 0 else ""
+    col, rem = divmod(col - 1, 26)
+    letter = _LETTERS[rem].lower() if lower else _LETTERS[rem]
+    return column_name(col, lower) + letter
+
+
+def split_location(location: str) -> Tuple[int, int]:
+    '''Converts cell location string to tuple (without checking that it is
+    within A1:ZZZZ9999). Throws ValueError if the location is malformed'''
+    match = _LOCATION.match(location)
+    if not match or " " in location:
+        raise ValueError("Invalid cell format.")
+    col, row = match.groups()
+    if row[0] == "0":
+        raise ValueError("Invalid cell format.")
+    return column_number(col), int(row)
+
+
+@lru_cache(maxsize = ADDRESS_CACHE_SIZE)
+def get_cell_tuple(location: str) -> Tuple[int, int]:
+    '''Converts cell location string to tuple
+     Throws ValueError if cell location is invalid'''
+    col, row = split_location(location)
+
+    # Check validity
+    if col < 1 or col > MAX_COL or row < 1 or row > MAX_ROW:
+        raise ValueError("Cell location must be within A1 and ZZZZ9999.")
+
+    return (col, row)
+
+
+def get_cell_name(loc: Tuple[int, int]) -> str:
+    '''Converts cell tuple to location string'''
+    col, row = loc
+    if col < 1 or row < 1:
+        raise ValueError("Invalid location tuple: {}".format(loc))
+    return column_name(col) + str(row)
+
+
+def get_location(col: int, row: int) -> str:
+    ''' Converts a (col, row) to the lowercase location string that cells
+        are stored under'''
+    return column_name(col, True) + str(row)
+
+
+# A (col, row) location packed into one int. Columns go up to ZZZZ
+# (475254 < 2 ** 19), and packed locations sort row by row.
+ROW_SHIFT = 19
+COL_MASK = (1 << ROW_SHIFT) - 1
+
+def pack_location(col: int, row: int) -> int:
+    '''Packs a (col, row) location into one int'''
+    return row << ROW_SHIFT | col
+
+def unpack_location(key: int) -> Tuple[int, int]:
+    '''Returns the (col, row) of a packed location'''
+    return key & COL_MASK, key >> ROW_SHIFT
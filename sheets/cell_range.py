@@ -0,0 +1,296 @@
+'''Cell range values passed to the aggregate functions'''
+from decimal import Decimal
+from .cell_address import get_location
+
+# Ranges of at least KEPT_SIZE cells keep their totals (see
+# CellDict.keep_totals)
+KEPT_SIZE = 1024
+
+# Ranges of at least SUMS_ROWS rows and at most SUMS_COLS columns are added
+# up from the sums of their columns (see CellDict.column_sums)
+SUMS_ROWS = 64
+SUMS_COLS = 8
+
+
+class CellRange:
+    ''' The cells of a range in an existing sheet, e.g. the A1:C1000 of
+        =SUM(A1:C1000). Functions that aggregate ranges only look at the
+        cells that exist in the sheet; the empty cells are counted rather
+        than read one by one. Other functions get the grid (list of lists)
+        of values instead.'''
+    def __init__(self, cells, rows, cols):
+        self.cells = cells # CellDict of the sheet
+        self.rows = rows
+        self.cols = cols
+
+    def size(self):
+        '''Number of cells in the range, empty or not'''
+        return len(self.rows) * len(self.cols)
+
+    def values(self):
+        ''' Returns the values of the range row by row, with a single None
+            for each run of empty cells. The aggregates give the same result
+            for a run of empty cells as for one of them.'''
+        top, left, width = self.rows[0], self.cols[0], len(self.cols)
+        values = []
+        position = 0 # position of the next cell in the flattened range
+        for row, col, value in self.cells.values_in(self.rows, self.cols):
+            cell_position = (row - top) * width + col - left
+            if cell_position > position:
+                values.append(None)
+            values.append(value)
+            position = cell_position + 1
+        if position < self.size():
+            values.append(None)
+        return values
+
+    def grid(self, attribute = "value"):
+        ''' Returns the list of lists of the values of the range, or of
+            another attribute of its cells (e.g. "contents")'''
+        top, left = self.rows[0], self.cols[0]
+        grid = [[None] * len(self.cols) for row in self.rows]
+        cells = self.cells
+        if attribute == "value":
+            for row, col, value in cells.values_in(self.rows, self.cols):
+                grid[row - top][col - left] = value
+            return grid
+        for row, col, location in cells.locations_in(self.rows, self.cols):
+            grid[row - top][col - left] = getattr(cells.peek(location), attribute)
+        return grid
+
+    def value_at(self, row, col):
+        '''Returns the value of the cell at (row, col) of the sheet'''
+        return self.cells.value(get_location(col, row), (col, row))
+
+    def lookup(self, key, vertical = True):
+        ''' Returns the row (or the col if not vertical) of the last cell of
+            the first column (or row) of the range whose value equals key, as
+            in VLOOKUP (and HLOOKUP), or None if there is none.
+
+            The {value : position} index of the column is kept by the cells
+            of the sheet, and shared by every lookup into it, until one of
+            its values changes (see CellDict.keep_lookup).'''
+        if vertical:
+            line = (self.rows, range(self.cols[0], self.cols[0] + 1))
+        else:
+            line = (range(self.rows[0], self.rows[0] + 1), self.cols)
+        index = self.cells.lookups.get(line)
+        if index is None:
+            index = {}
+            found = set()
+            for row, col, value in self.cells.values_in(*line):
+                position = row if vertical else col
+                index[value] = position
+                found.add(position)
+            # Empty cells equal None as well
+            for position in reversed(line[0] if vertical else line[1]):
+                if position not in found:
+                    index[None] = max(position, index.get(None, 0))
+                    break
+            self.cells.keep_lookup(line, index)
+        return index.get(key)
+
+    def totals(self):
+        ''' Returns the RangeTotals of the range if its cells are all numbers
+            or empty, or None if a cell has another value (e.g. text or an
+            error). The totals of a large range are kept by the cells of the
+            sheet and updated as its values change, so that they are only
+            worked out once.'''
+        key = (self.rows, self.cols)
+        totals = self.cells.totals.get(key)
+        if totals is not None:
+            return totals
+        parts = []
+        if len(self.rows) >= SUMS_ROWS and len(self.cols) <= SUMS_COLS:
+            # Tall ranges of a few columns (e.g. running totals) are added
+            # up from the sums of their columns
+            for col in self.cols:
+                part = self.cells.column_sums(col).totals(self.rows[0], self.rows[-1])
+                if part is None:
+                    return None
+                parts.append(part)
+        else:
+            for row, col, value in self.cells.cell_values_in(self.rows, self.cols):
+                if value is None:
+                    continue
+                if not is_number(value):
+                    return None
+                number, places, absolute, count = scaled(value)
+                parts.append((number, places, absolute, {places: 1}))
+            # The stored numbers are added up in their columns, without
+            # making a Decimal of each
+            for col, column in self.cells.number_columns(self.cols):
+                parts.append(column.total(self.rows[0], self.rows[-1]))
+        totals = RangeTotals(parts)
+        if self.size() >= KEPT_SIZE:
+            self.cells.keep_totals(key, totals)
+        return totals
+
+    def total(self):
+        ''' Returns (total, places, absolute, count) if the cells of the range
+            are all numbers or empty: the sum of the numbers is total *
+            10**-places, absolute is the sum of their absolute values in the
+            same unit, and count is how many there are. Returns None if a
+            cell has another value.'''
+        totals = self.totals()
+        return None if totals is None else totals.sum()
+
+    def extreme(self, largest = False):
+        ''' Returns (value, count) if the cells of the range are all numbers
+            or empty: value is the first smallest (or largest) number, row by
+            row, or None if there are none, and count is how many numbers
+            there are. Returns None if a cell has another value.'''
+        totals = self.totals()
+        if totals is None:
+            return None
+        if not totals.count:
+            return None, 0
+        best = totals.largest if largest else totals.smallest
+        if best is None:
+            best = self._extreme(largest)
+            if largest:
+                totals.largest = best
+            else:
+                totals.smallest = best
+        return best[0], totals.count
+
+    def _extreme(self, largest):
+        ''' Returns (value, row, col) of the first smallest (or largest)
+            number of a range that has numbers and empty cells only'''
+        found = [] # (value, row, col) of the extreme of each column
+        for row, col, value in self.cells.cell_values_in(self.rows, self.cols):
+            if value is not None:
+                found.append((value, row, col))
+        for col, column in self.cells.number_columns(self.cols):
+            extreme = column.extreme(self.rows[0], self.rows[-1], largest)
+            if extreme is not None:
+                value, row = extreme
+                found.append((value, row, col))
+        best = max(found)[0] if largest else min(found)[0]
+        # Of equal numbers (e.g. 1 and 1.0), the first one is kept
+        row, col, value = min((row, col, value) for value, row, col in found
+            if value == best)
+        return value, row, col
+
+
+class RangeTotals:
+    ''' The sum, count, smallest and largest of the numbers of a range of
+        numbers and empty cells. They are updated with the old and new value
+        of a cell of the range that changes (see update), so that SUM,
+        AVERAGE, MIN and MAX of a large range cost the same whatever its
+        size when one of its cells changes.
+
+        The sum is kept as an integer in units of 10**-places, with the
+        number of numbers that have each number of decimal places (so that
+        the sum has as many places as the numbers still in the range). The
+        smallest and largest are (value, row, col), or None when they have
+        to be found again: when the cell that had one changes.'''
+    __slots__ = ("total", "places", "absolute", "counts", "count", "smallest",
+        "largest")
+
+    def __init__(self, parts):
+        ''' Adds up (total, places, absolute, {places : count}) parts, see
+            NumberColumn.total'''
+        self.places = max((part[1] for part in parts), default = 0)
+        self.total = self.absolute = 0
+        self.counts = {}
+        for number, places, absolute, counts in parts:
+            scale = 10 ** (self.places - places)
+            self.total += number * scale
+            self.absolute += absolute * scale
+            for count_places, count in counts.items():
+                self.counts[count_places] = self.counts.get(count_places, 0) + count
+        self.count = sum(self.counts.values())
+        self.smallest = None
+        self.largest = None
+
+    def sum(self):
+        '''Returns (total, places, absolute, count), see CellRange.total'''
+        places = max(self.counts, default = 0)
+        scale = 10 ** (self.places - places)
+        return self.total // scale, places, self.absolute // scale, self.count
+
+    def update(self, row, col, old_value, new_value):
+        ''' Updates the totals after the value of the cell at (row, col)
+            changed. Returns False if they can not be kept up to date, since
+            the new value is not a number.'''
+        if new_value is not None and not is_number(new_value):
+            return False
+        if old_value is not None:
+            self._add(old_value, -1)
+        if new_value is not None:
+            self._add(new_value, 1)
+
+        # The first smallest and largest are only found again if the cell
+        # that had one changes for the worse
+        position = (row, col)
+        for best, better in ((self.smallest, Decimal.__lt__),
+                (self.largest, Decimal.__gt__)):
+            if best is None:
+                continue
+            value, best_position = best[0], best[1:]
+            if new_value is not None and (better(new_value, value) or
+                    new_value == value and position <= best_position):
+                best = (new_value, row, col)
+            elif position == best_position:
+                best = None
+            if better is Decimal.__lt__:
+                self.smallest = best
+            else:
+                self.largest = best
+        return True
+
+    def _add(self, value, sign):
+        '''Adds a number to the totals (sign 1) or takes it away (sign -1)'''
+        number, places, absolute, count = scaled(value)
+        if places > self.places:
+            scale = 10 ** (places - self.places)
+            self.total *= scale
+            self.absolute *= scale
+            self.places = places
+        scale = 10 ** (self.places - places)
+        self.total += sign * number * scale
+        self.absolute += sign * absolute * scale
+        self.count += sign
+        count = self.counts.get(places, 0) + sign
+        if count:
+            self.counts[places] = count
+        else:
+            del self.counts[places]
+
+
+def is_number(value):
+    '''True if a value is a number the totals can add up'''
+    return type(value) == Decimal and value.is_finite()
+
+
+def scaled(value):
+    ''' Returns (total, places, absolute, count) for a single finite
+        Decimal, see CellRange.total'''
+    # Read from the string of the number unless it has an exponent, which
+    # is quicker than as_tuple
+    text = str(value)
+    if "E" not in text:
+        point = text.find(".")
+        if point < 0:
+            number = int(text)
+            return number, 0, abs(number), 1
+        number = int(text[:point] + text[point + 1:])
+        return number, len(text) - point - 1, abs(number), 1
+    sign, digits, exponent = value.as_tuple()
+    number = int("".join(map(str, digits))) * 10 ** max(exponent, 0)
+    if sign:
+        number = -number
+    return number, max(-exponent, 0), abs(number), 1
+
+
+def add_totals(parts):
+    '''Adds up (total, places, absolute, count) tuples, see CellRange.total'''
+    most = max((part[1] for part in parts), default = 0)
+    total = absolute = count = 0
+    for number, places, size, found in parts:
+        scale = 10 ** (most - places)
+        total += number * scale
+        absolute += size * scale
+        count += found
+    return total, most, absolute, count
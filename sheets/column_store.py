@@ -0,0 +1,124 @@
+'''Compact storage for the numbers of a column of a sheet'''
+from array import array
+from collections import Counter
+from decimal import Decimal
+from itertools import compress
+from operator import mul
+
+# A number is stored as an integer of up to 18 digits (it fits in 64 bits)
+# and its number of decimal places
+MAX_DIGITS = 18
+MAX_PLACES = 255
+
+# A column only grows to the row of a new number if at least one in
+# DENSITY of its rows (or of the first MIN_ROWS) would have a number, so
+# a few numbers far down a column are kept as cells instead
+MIN_ROWS = 256
+DENSITY = 4
+
+
+class NumberColumn:
+    ''' The numbers of one column of a sheet, in typed arrays indexed by
+        row: the digits of each number as an integer, its number of decimal
+        places, and whether the row has a number (the validity mask). A
+        number costs 10 bytes here, instead of a Cell with its contents
+        string and Decimal value.
+
+        Only numbers that can be rebuilt exactly are stored: their contents
+        are the string of their value, e.g. "12.5" but not "12.50" or
+        "'12".'''
+    __slots__ = ("digits", "places", "valid", "count")
+
+    def __init__(self):
+        self.digits = array("q")
+        self.places = array("B")
+        self.valid = bytearray()
+        self.count = 0 # number of rows with a number
+
+    def has(self, row):
+        '''True if the row has a number'''
+        return row < len(self.valid) and self.valid[row] == 1
+
+    def get(self, row):
+        '''Returns the number at a row that has one, as a Decimal'''
+        places = self.places[row]
+        if places:
+            return Decimal(self.digits[row]).scaleb(-places)
+        return Decimal(self.digits[row])
+
+    def add(self, row, text):
+        ''' Stores a number at a row, given as the string of its Decimal
+            (e.g. "-12.5"). Returns False (and stores nothing) if it does not
+            fit, or if the column would get too sparse.'''
+        point = text.find(".")
+        places = len(text) - point - 1 if point >= 0 else 0
+        length = len(text) - (point >= 0) - (text[0] == "-")
+        if length > MAX_DIGITS or places > MAX_PLACES or text == "-0":
+            return False
+
+        valid = self.valid
+        if row >= len(valid):
+            if row >= max(MIN_ROWS, DENSITY * (self.count + 1)):
+                return False
+            grow = row + 1 - len(valid)
+            self.digits.frombytes(bytes(8 * grow))
+            self.places.frombytes(bytes(grow))
+            valid.extend(bytes(grow))
+        if not valid[row]:
+            valid[row] = 1
+            self.count += 1
+        self.digits[row] = int(text.replace(".", "", 1)) if places else int(text)
+        self.places[row] = places
+        return True
+
+    def remove(self, row):
+        '''Removes the number at a row, if there is one'''
+        if self.has(row):
+            self.valid[row] = 0
+            self.count -= 1
+
+    def _numbers(self, top, bottom):
+        ''' Returns the digits and places of the numbers from row top to
+            bottom, and the rows they are in'''
+        valid = self.valid[top:bottom + 1]
+        return compress(self.digits[top:bottom + 1], valid), \
+            compress(self.places[top:bottom + 1], valid), \
+            compress(range(top, top + len(valid)), valid)
+
+    def scaled(self, top, bottom):
+        ''' Returns the numbers from row top to bottom as integers in units
+            of their most decimal places, that number of places, the number
+            of places of each number (bytes) and an iterator over their rows'''
+        digits, places, rows = self._numbers(top, bottom)
+        places = bytes(places)
+        most = max(places, default = 0)
+        if not most:
+            return list(digits), 0, places, rows
+        scales = [10 ** (most - p) for p in range(most + 1)]
+        return list(map(mul, digits, map(scales.__getitem__, places))), most, \
+            places, rows
+
+    def total(self, top, bottom):
+        ''' Returns (total, places, absolute, counts) for the numbers from row
+            top to bottom: their sum is total * 10**-places, absolute is the
+            sum of their absolute values in the same unit, and counts is
+            {places : count} of how many of them have each number of decimal
+            places'''
+        numbers, most, places, rows = self.scaled(top, bottom)
+        return sum(numbers), most, sum(map(abs, numbers)), dict(Counter(places))
+
+    def extreme(self, top, bottom, largest = False):
+        ''' Returns (value, row) of the first smallest (or largest) number
+            from row top to bottom, or None if there are none'''
+        numbers, most, places, rows = self.scaled(top, bottom)
+        if not numbers:
+            return None
+        index = numbers.index(max(numbers) if largest else min(numbers))
+        row = list(rows)[index]
+        return self.get(row), row
+
+    def rows(self, top = 0, bottom = None):
+        '''Returns the rows from top to bottom that have a number'''
+        valid = self.valid
+        end = len(valid) if bottom is None else min(bottom + 1, len(valid))
+        return [row for row in range(top, end) if valid[row]]
@@ -0,0 +1,139 @@
+'''Running sums of the columns of a sheet, for aggregates of their ranges'''
+from .cell_address import MAX_ROW
+from .cell_range import is_number, scaled
+
+
+class FenwickTree:
+    ''' A Fenwick tree (binary indexed tree) of integers indexed from 0:
+        a value can be changed, and the sum of a run of values found, in
+        O(log n) steps'''
+    __slots__ = ("tree",)
+
+    def __init__(self, values):
+        # tree[i] holds the sum of the values i - (i & -i) to i - 1
+        tree = [0] + values
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def add(self, index, delta):
+        '''Adds delta to the value at index'''
+        tree = self.tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def prefix(self, stop):
+        '''Returns the sum of the values before index stop'''
+        tree = self.tree
+        total = 0
+        while stop:
+            total += tree[stop]
+            stop &= stop - 1
+        return total
+
+    def sum(self, start, stop):
+        '''Returns the sum of the values from index start to stop - 1'''
+        return self.prefix(stop) - self.prefix(start)
+
+    def scale(self, factor):
+        '''Multiplies every value by factor'''
+        self.tree = [value * factor for value in self.tree]
+
+
+class ColumnSums:
+    ''' Fenwick trees of the values of one column of a sheet, indexed by
+        row: the numbers as integers in units of 10**-places, their absolute
+        values, how many numbers have each number of decimal places, and
+        how many other values (text, booleans, errors) there are. The totals
+        of any run of rows (see CellRange.totals) are then found in O(log
+        rows) steps, so that running totals (=SUM($A$1:A2), =SUM($A$1:A3),
+        ...) and sliding windows do not each go through their range.
+
+        The trees are kept up to date with the old and new value of each
+        cell of the column that changes (see update).'''
+    __slots__ = ("places", "sums", "absolutes", "counts", "others")
+
+    def __init__(self, values, column = None):
+        ''' values are the (row, col, value) of the Cells of the column, and
+            column is its NumberColumn of stored numbers, if it has one'''
+        size = MAX_ROW + 1
+        sums = [0] * size
+        absolutes = [0] * size
+        others = [0] * size
+        counts = {}
+        found = [] # (row, number, places) of the numbers of the Cells
+        for row, col, value in values:
+            if value is None:
+                continue
+            if not is_number(value):
+                others[row] = 1
+                continue
+            number, places, absolute, count = scaled(value)
+            found.append((row, number, places))
+
+        stored, most, stored_places, rows = [], 0, b"", ()
+        if column is not None:
+            stored, most, stored_places, rows = column.scaled(1, MAX_ROW)
+        self.places = max([most] + [places for row, number, places in found])
+        scale = 10 ** (self.places - most)
+        for row, number, places in zip(rows, stored, stored_places):
+            sums[row] = number * scale
+            absolutes[row] = abs(sums[row])
+            if places not in counts:
+                counts[places] = [0] * size
+            counts[places][row] = 1
+        for row, number, places in found:
+            sums[row] = number * 10 ** (self.places - places)
+            absolutes[row] = abs(sums[row])
+            if places not in counts:
+                counts[places] = [0] * size
+            counts[places][row] = 1
+
+        self.sums = FenwickTree(sums)
+        self.absolutes = FenwickTree(absolutes)
+        self.others = FenwickTree(others)
+        self.counts = {places: FenwickTree(rows) for places, rows in counts.items()}
+
+    def totals(self, top, bottom):
+        ''' Returns (total, places, absolute, counts) for the rows from top
+            to bottom, like NumberColumn.total, or None if they have a value
+            that is not a number'''
+        stop = bottom + 1
+        if self.others.sum(top, stop):
+            return None
+        counts = {}
+        for places, tree in self.counts.items():
+            count = tree.sum(top, stop)
+            if count:
+                counts[places] = count
+        return self.sums.sum(top, stop), self.places, \
+            self.absolutes.sum(top, stop), counts
+
+    def update(self, row, old_value, new_value):
+        '''Updates the trees after the value at a row changed'''
+        self._add(row, old_value, -1)
+        self._add(row, new_value, 1)
+
+    def _add(self, row, value, sign):
+        '''Adds a value to the trees (sign 1) or takes it away (sign -1)'''
+        if value is None:
+            return
+        if not is_number(value):
+            self.others.add(row, sign)
+            return
+        number, places, absolute, count = scaled(value)
+        if places > self.places:
+            scale = 10 ** (places - self.places)
+            self.sums.scale(scale)
+            self.absolutes.scale(scale)
+            self.places = places
+        scale = 10 ** (self.places - places)
+        self.sums.add(row, sign * number * scale)
+        self.absolutes.add(row, sign * absolute * scale)
+        if places not in self.counts:
+            self.counts[places] = FenwickTree([0] * (MAX_ROW + 1))
+        self.counts[places].add(row, sign)
@@ -0,0 +1,167 @@
+'''Graph algorithms for the cell dependency graph'''
+
+
+def strongly_connected_components(nodes, successors):
+    ''' Tarjan's algorithm. nodes is an iterable of nodes and successors a
+        dict {node : list of nodes}; successors outside of nodes are
+        ignored. Returns the list of components (lists of nodes) in
+        topological order: a component comes before every component it
+        has an edge to.
+
+        The search is iterative so that long chains of cells do not hit the
+        recursion limit.'''
+    nodes = list(nodes)
+    in_graph = set(nodes)
+    index = {} # order in which nodes were found
+    lowlink = {}
+    stack = [] # nodes of components that are not finished yet
+    on_stack = set()
+    components = []
+
+    for start in nodes:
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        # (node, iterator over its successors)
+        work = [(start, iter(successors.get(start, ())))]
+        while work:
+            node, edges = work[-1]
+            for succ in edges:
+                if succ not in in_graph:
+                    continue
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(successors.get(succ, ()))))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                # Every successor was visited: node is finished
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    # Tarjan finishes a component after the components it reaches
+    components.reverse()
+    return components
+
+
+def is_cycle(component, successors):
+    '''True if a strongly connected component is a cycle'''
+    if len(component) > 1:
+        return True
+    node = component[0]
+    return node in successors.get(node, ())
+
+
+class RangeIndex:
+    ''' The cell ranges read by formulas, e.g. the A1:A1000 of
+        =SUM(A1:A1000). A range is one dependency of the formula instead of
+        one edge (and one placeholder cell) per cell it covers.
+
+        A range is (sheet, (left, top), (right, bottom)), and the formula
+        reading it is its consumer, a (sheet, cell) key like the ones in
+        Cell.children. Ranges are filed under every block of BLOCK_ROWS rows
+        and BLOCK_COLS columns they overlap, so the consumers of a cell are
+        found by checking the ranges of one block rather than every range.
+        Ranges over more than WIDE_BLOCKS blocks of columns are filed under
+        the blocks of rows only (column block None).'''
+    BLOCK_ROWS = 64
+    BLOCK_COLS = 1
+    WIDE_BLOCKS = 8
+
+    def __init__(self):
+        self.ranges = {} # {consumer : list of ranges}
+        # {(sheet, row block, col block) : {(consumer, range) : order added}}
+        self.blocks = {}
+        self.sheets = {} # {sheet : {(consumer, range) : None}}
+        self.added = 0 # number of ranges added, for their order
+
+    def _blocks(self, cell_range):
+        '''Returns the (sheet, row block, col block) a range is filed under'''
+        sheet, (left, top), (right, bottom) = cell_range
+        col_blocks = range(left // self.BLOCK_COLS, right // self.BLOCK_COLS + 1)
+        if len(col_blocks) > self.WIDE_BLOCKS:
+            col_blocks = [None]
+        return [(sheet, row_block, col_block)
+            for row_block in range(top // self.BLOCK_ROWS, bottom // self.BLOCK_ROWS + 1)
+            for col_block in col_blocks]
+
+    def set_ranges(self, consumer, ranges):
+        '''Replaces the ranges read by a consumer'''
+        if consumer in self.ranges:
+            self.remove(consumer)
+        ranges = list(dict.fromkeys(ranges))
+        if not ranges:
+            return
+        self.ranges[consumer] = ranges
+        for cell_range in ranges:
+            entry = (consumer, cell_range)
+            self.added += 1
+            for block in self._blocks(cell_range):
+                self.blocks.setdefault(block, {})[entry] = self.added
+            self.sheets.setdefault(cell_range[0], {})[entry] = None
+
+    def remove(self, consumer):
+        '''Removes the ranges read by a consumer'''
+        for cell_range in self.ranges.pop(consumer, ()):
+            entry = (consumer, cell_range)
+            for block in self._blocks(cell_range):
+                entries = self.blocks[block]
+                del entries[entry]
+                if not entries:
+                    del self.blocks[block]
+            entries = self.sheets[cell_range[0]]
+            del entries[entry]
+            if not entries:
+                del self.sheets[cell_range[0]]
+
+    def has_ranges(self, consumer):
+        '''True if the consumer reads any range'''
+        return consumer in self.ranges
+
+    def consumers(self, sheet, location):
+        ''' Returns the consumers of ranges containing the (col, row)
+            location of a sheet, in the order they were added'''
+        col, row = location
+        row_block = row // self.BLOCK_ROWS
+        found = []
+        for col_block in (None, col // self.BLOCK_COLS):
+            for (consumer, (_, (left, top), (right, bottom))), added in \
+                    self.blocks.get((sheet, row_block, col_block), {}).items():
+                if left <= col <= right and top <= row <= bottom:
+                    found.append((added, consumer))
+        found.sort()
+        return list(dict.fromkeys(consumer for added, consumer in found))
+
+    def sheet_consumers(self, sheet):
+        '''Returns the consumers of ranges in a sheet'''
+        return list(dict.fromkeys(consumer for consumer, _ in self.sheets.get(sheet, ())))
+
+    def rename_sheet(self, old_name, new_name):
+        ''' Renames a sheet in the consumers and ranges. Formulas that
+            referred to the sheet by name are rewritten to the new name by
+            the workbook, so their ranges follow the sheet.'''
+        affected = [consumer for consumer in self.ranges if consumer[0] == old_name]
+        affected += self.sheet_consumers(old_name)
+        for consumer in dict.fromkeys(affected):
+            ranges = [(new_name if sheet == old_name else sheet, corner1, corner2)
+                for sheet, corner1, corner2 in self.ranges[consumer]]
+            self.remove(consumer)
+            if consumer[0] == old_name:
+                consumer = (new_name, consumer[1])
+            self.set_ranges(consumer, ranges)
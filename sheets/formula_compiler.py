@@ -0,0 +1,576 @@
+'''Compiles parsed formulas into nested Python closures.
+
+The lark Transformer in formula_parser.py (eval_exp) walks the whole parse
+tree on every evaluation and wraps every intermediate value in a new Tree.
+Here the tree is lowered once into closures that take an evaluation context
+and return plain values. eval_exp remains the reference evaluator; the
+compiled closures must produce exactly the same values.'''
+from decimal import Decimal, DecimalException
+from functools import lru_cache
+import re
+from .errors import CellError, CellErrorType
+from .cell_address import column_number, get_location
+from .helper_functions import compare, convert_to_string
+from .cell_range import CellRange
+from .functions import RANGE_FUNCTIONS
+
+NON_NUMBERS = [str(Decimal("Infinity")), str(Decimal("Nan")),
+    str(Decimal("-Infinity")), str(Decimal("-Nan"))]
+
+
+class EvalContext:
+    '''State of a single formula evaluation: the workbook, the sheet of the
+       cell being evaluated, and the cells read along the way.'''
+    def __init__(self, wb, curr_sheet):
+        self.wb = wb
+        self.curr_sheet = curr_sheet
+        self.parent_cells = [] # (sheet, cell) tuples that were read
+        self.bad_cells = [] # Cells read in a nonexistent sheet
+        # (sheet, (left, top), (right, bottom)) cell ranges that were read,
+        # whether or not the sheet exists
+        self.parent_ranges = []
+        self.indirect_stack = [] # Strings currently resolved by INDIRECT
+        # Cell names and range bounds of the formula being evaluated
+        self.refs = None
+        self.ranges = None
+
+
+class FormulaTemplate:
+    '''A formula parse tree lowered into closures.
+
+    Cell references are compiled relative to the origin (the location of
+    the cell the tree was parsed from), so one template is shared by every
+    cell holding the same formula shifted to its own location. A template
+    built from an unparseable formula (tree is None) evaluates to a
+    PARSE_ERROR.'''
+    def __init__(self, tree, origin = (0, 0)):
+        self.cell_slots = [] # (col_abs, col, row_abs, row) of every cell
+        self.range_slots = [] # (corner slot, corner slot) of every range
+        self.origin = origin
+        if tree is None:
+            self._root = None
+            self._zero_if_empty = False
+        else:
+            self._root = _compile(tree, self)
+            # A lone reference evaluates to 0 when the referenced cell is empty
+            self._zero_if_empty = _is_reference(tree)
+
+    def bind(self, anchor):
+        '''Returns the Formula of this template for the cell at anchor'''
+        return Formula(self, anchor)
+
+
+class Formula:
+    '''A formula template bound to the location of a cell.
+
+    Calling evaluate() returns the value of the formula, which is never a
+    cell range; exceptions raised during evaluation become PARSE_ERRORs, as
+    they do when eval_exp is run by lark.'''
+    # Every formula cell has one, so it is kept small
+    __slots__ = ("template", "anchor", "refs", "ranges")
+
+    def __init__(self, template, anchor):
+        self.template = template
+        self.anchor = anchor
+        self.refs = tuple(_resolve(slot, anchor) for slot in template.cell_slots)
+        self.ranges = tuple(_resolve_range(slot, anchor) for slot in template.range_slots)
+
+    def evaluate(self, ctx):
+        '''Evaluate the formula in the given context'''
+        template = self.template
+        if template._root is None:
+            return CellError(CellErrorType.PARSE_ERROR,
+                detail = "Can not parse formula")
+
+        saved = ctx.refs, ctx.ranges
+        ctx.refs, ctx.ranges = self.refs, self.ranges
+        try:
+            value = template._root(ctx)
+        except Exception as e: # pylint: disable=broad-except
+            return CellError(CellErrorType.PARSE_ERROR,
+                detail = "Can not evaluate formula", exception = e)
+        finally:
+            ctx.refs, ctx.ranges = saved
+
+        if value is None and template._zero_if_empty:
+            return Decimal(0)
+        # If the value is a cell_range object (list of lists), it is TYPE_ERR0R
+        if type(value) == list:
+            return CellError(CellErrorType.TYPE_ERROR,
+                detail = "function received cell range")
+        return value
+
+
+def compile_formula(tree, anchor = (0, 0)):
+    '''Lower a formula parse tree of the cell at anchor into a Formula'''
+    return FormulaTemplate(tree, anchor).bind(anchor)
+
+
+# Quoted strings and names, or runs of characters that may be a cell reference
+_KEY_TOKEN = re.compile(r'"[^"]*"|\'[^\']*\'|[$A-Za-z0-9_.]+')
+_CELLREF = re.compile(r'(\$?)([A-Za-z]+)(\$?)([1-9][0-9]*)')
+# Names followed by these are function names or sheet names (but not by
+# the != operator, as in the grammar)
+_CALL_OR_SHEET = re.compile(r'\s*(\(|!(?!=))')
+
+def formula_key(contents, anchor):
+    ''' Returns the position-independent (R1C1-style) form of formula
+        contents for the cell at anchor: a tuple of the text between cell
+        references and a (col_abs, col, row_abs, row) tuple per reference,
+        where relative coordinates are offsets from the anchor. Formulas
+        filled down or across a region share the same key.'''
+    parts = []
+    pos = 0
+    for match in _KEY_TOKEN.finditer(contents):
+        ref = _CELLREF.fullmatch(match.group())
+        if ref is None or _CALL_OR_SHEET.match(contents, match.end()):
+            continue
+        parts.append(contents[pos:match.start()])
+        parts.append(_relative_ref(ref.groups(), anchor))
+        pos = match.end()
+    parts.append(contents[pos:])
+    return tuple(parts)
+
+
+def _relative_ref(groups, origin):
+    ''' Converts the ($, column letters, $, row digits) of a reference to
+        a (col_abs, col, row_abs, row) slot relative to origin. The
+        coordinates may be outside the valid area.'''
+    col_abs, letters, row_abs, row = groups
+    col = column_number(letters)
+    row = int(row)
+    return (col_abs == "$", col if col_abs else col - origin[0],
+        row_abs == "$", row if row_abs else row - origin[1])
+
+
+def _resolve(slot, anchor):
+    ''' Returns the (lowercase cell name, valid) of a slot for the cell at
+        anchor. valid is False if the location is outside of A1:ZZZZ9999.'''
+    col_abs, col, row_abs, row = slot
+    if not col_abs:
+        col += anchor[0]
+    if not row_abs:
+        row += anchor[1]
+    if col < 1 or row < 1:
+        return "#ref!", False
+    return get_location(col, row), col <= 475254 and row <= 9999
+
+
+def _resolve_range(slot, anchor):
+    ''' Returns (rows, cols) ranges spanned by a range slot for the cell at
+        anchor, or None if a corner is outside of A1:ZZZZ9999'''
+    corners = []
+    for col_abs, col, row_abs, row in slot:
+        if not col_abs:
+            col += anchor[0]
+        if not row_abs:
+            row += anchor[1]
+        if col < 1 or col > 475254 or row < 1 or row > 9999:
+            return None
+        corners.append((col, row))
+    (c1, r1), (c2, r2) = corners
+    return range(min(r1, r2), max(r1, r2) + 1), range(min(c1, c2), max(c1, c2) + 1)
+
+
+def _is_reference(node):
+    ''' True if the node evaluates like a cell reference (an empty cell
+        becomes 0 when it is the whole formula).'''
+    if node.data == "cell":
+        return True
+    return node.data == "function_expr" and node.children[0] == "INDIRECT"
+
+
+def _normalize(value):
+    '''Normalizes the result of an arithmetic operation'''
+    return Decimal('{:f}'.format(value.normalize()))
+
+
+def _to_numbers(n1, n2):
+    ''' Converts two operands to numbers. Raises ValueError or a
+        DecimalException if that is not possible.'''
+    n1 = Decimal(n1) if n1 is not None else Decimal(0)
+    n2 = Decimal(n2) if n2 is not None else Decimal(0)
+    if str(n1) in NON_NUMBERS or str(n2) in NON_NUMBERS:
+        raise ValueError("Arithmetic with Infinity or NaN")
+    return n1, n2
+
+
+def _compile(node, template):
+    ''' Returns a closure ctx -> value for the given parse tree node, adding
+        its cell references to the slots of the template'''
+    return _COMPILERS[node.data](node, template)
+
+
+def _compile_number(node, template):
+    '''number literal'''
+    value = Decimal(node.children[0])
+    return lambda ctx: value
+
+
+def _compile_string(node, template):
+    '''string literal'''
+    value = str(node.children[0])[1:-1]
+    return lambda ctx: value
+
+
+def _compile_bool(node, template):
+    '''bool literal'''
+    value = node.children[0].lower() != "false"
+    return lambda ctx: value
+
+
+def _compile_add_expr(node, template):
+    '''Add expressions'''
+    f1 = _compile(node.children[0], template)
+    f2 = _compile(node.children[2], template)
+    subtract = node.children[1] == "-"
+
+    def add_expr(ctx):
+        n1 = f1(ctx)
+        n2 = f2(ctx)
+        # Check for CellErrors
+        if isinstance(n1, CellError):
+            return n1
+        if isinstance(n2, CellError):
+            return n2
+
+        # Type checking
+        try:
+            n1, n2 = _to_numbers(n1, n2)
+        except (ValueError, DecimalException):
+            return CellError(CellErrorType.TYPE_ERROR,
+                detail = "add/sub with non-numbers")
+
+        return _normalize(n1 - n2 if subtract else n1 + n2)
+    return add_expr
+
+
+def _compile_mul_expr(node, template):
+    '''Multiply expressions'''
+    f1 = _compile(node.children[0], template)
+    f2 = _compile(node.children[2], template)
+    multiply = node.children[1] == "*"
+
+    def mul_expr(ctx):
+        n1 = f1(ctx)
+        n2 = f2(ctx)
+        # Check for CellErrors
+        if isinstance(n1, CellError):
+            return n1
+        if isinstance(n2, CellError):
+            return n2
+
+        # Type checking
+        try:
+            n1, n2 = _to_numbers(n1, n2)
+        except (ValueError, DecimalException):
+            return CellError(CellErrorType.TYPE_ERROR,
+                detail = "mult/div with non-numbers")
+
+        # Calculate value
+        if multiply:
+            return _normalize(n1 * n2)
+        if n2 != Decimal(0):
+            return _normalize(n1 / n2)
+        return CellError(CellErrorType.DIVIDE_BY_ZERO,
+            detail = "Divide by zero in formula.")
+    return mul_expr
+
+
+def _compile_unary_op(node, template):
+    '''Unary operations'''
+    negate = node.children[0] == "-"
+    f1 = _compile(node.children[1], template)
+
+    def unary_op(ctx):
+        n1 = f1(ctx)
+        if isinstance(n1, CellError):
+            return n1
+
+        # Type checking
+        try:
+            n1 = Decimal(n1) if n1 is not None else Decimal(0)
+            if str(n1) in NON_NUMBERS:
+                raise ValueError("Unary with Infinity or NaN")
+        except (ValueError, DecimalException):
+            return CellError(CellErrorType.TYPE_ERROR,
+                detail = "Unary with non-numbers")
+
+        return -1 * n1 if negate else n1
+    return unary_op
+
+
+def _concat_string(s):
+    '''Converts a concat operand to a string'''
+    if type(s) == bool:
+        return str(s).upper()
+    if s is None:
+        return ""
+    if type(s) == str:
+        return s
+    return '{:f}'.format(s.normalize())
+
+
+def _compile_concat_expr(node, template):
+    '''string concat'''
+    f1 = _compile(node.children[0], template)
+    f2 = _compile(node.children[1], template)
+
+    def concat_expr(ctx):
+        s1 = f1(ctx)
+        s2 = f2(ctx)
+        # Check for CellErrors
+        if isinstance(s1, CellError):
+            return s1
+        if isinstance(s2, CellError):
+            return s2
+        return _concat_string(s1) + _concat_string(s2)
+    return concat_expr
+
+
+def _compile_compare_expr(node, template):
+    '''comparing expressions'''
+    f1 = _compile(node.children[0], template)
+    f2 = _compile(node.children[2], template)
+    op = str(node.children[1])
+
+    def compare_expr(ctx):
+        b1 = f1(ctx)
+        b2 = f2(ctx)
+        if isinstance(b1, CellError):
+            return b1
+        if isinstance(b2, CellError):
+            return b2
+        return compare(b1, b2, op)
+    return compare_expr
+
+
+def _function_args(node):
+    '''Returns the argument nodes of a function_expr node'''
+    func_args = node.children[1]
+    if func_args.data == "arg_list":
+        return func_args.children
+    return [func_args]
+
+
+def _compile_function_call(node, template):
+    ''' Returns a closure ctx -> (failed, value) for a call to a function
+        in the workbook's function dictionary. failed is True if the value
+        is an error raised by the call rather than a value returned by it.'''
+    func_name = str(node.children[0])
+    arg_fns = [_compile_cell_range(arg, template, sparse = True)
+        if arg.data == "cell_range" else _compile(arg, template)
+        for arg in _function_args(node)]
+
+    def function_call(ctx):
+        # Arguments are evaluated before the function is looked up
+        args = [f(ctx) for f in arg_fns]
+
+        func = ctx.wb.functions.get(func_name)
+        if func is None:
+            return True, CellError(CellErrorType.BAD_NAME,
+                detail = "Function does not exist")
+        if func not in RANGE_FUNCTIONS:
+            args = [a.grid() if type(a) == CellRange else a for a in args]
+
+        try:
+            return False, func(*args)
+        except ValueError as e:
+            # Catch bad_name errors in cell ranges
+            if "bad cell" in str(e):
+                return True, CellError(CellErrorType.BAD_NAME, detail = e)
+            # Any other error is a type error
+            return True, CellError(CellErrorType.TYPE_ERROR, detail = e)
+    return function_call
+
+
+def _compile_function_expr(node, template):
+    '''function expressions'''
+    if node.children[0] == "INDIRECT":
+        return _compile_indirect(node, template)
+
+    function_call = _compile_function_call(node, template)
+    return lambda ctx: function_call(ctx)[1]
+
+
+def _compile_tagged(node, template):
+    ''' Returns a closure ctx -> (is_reference, value) for the argument of
+        INDIRECT. is_reference is True for values INDIRECT passes through
+        unchanged: cells, cell ranges and errors that were not returned by
+        a function.'''
+    if node.data in ["cell", "cell_range"] or (node.data == "function_expr"
+            and node.children[0] == "INDIRECT"):
+        f = _compile(node, template)
+        return lambda ctx: (True, f(ctx))
+
+    if node.data in ["number", "string", "bool"]:
+        f = _compile(node, template)
+        return lambda ctx: (False, f(ctx))
+
+    if node.data == "function_expr":
+        return _compile_function_call(node, template)
+
+    f = _compile(node, template)
+    def tagged(ctx):
+        value = f(ctx)
+        return isinstance(value, CellError), value
+    return tagged
+
+
+def _compile_indirect(node, template):
+    '''INDIRECT function'''
+    arg_nodes = _function_args(node)
+    if len(arg_nodes) != 1:
+        arg_fns = [_compile(arg, template) for arg in arg_nodes]
+        def indirect_args(ctx):
+            for f in arg_fns:
+                f(ctx)
+            return CellError(CellErrorType.TYPE_ERROR,
+                detail = "INDIRECT takes exactly 1 argument.")
+        return indirect_args
+
+    tagged = _compile_tagged(arg_nodes[0], template)
+    def indirect(ctx):
+        is_reference, value = tagged(ctx)
+        if is_reference:
+            return value
+        # basically: can it be converted to a string/is a string
+        try:
+            str_arg = convert_to_string(value)
+        except ValueError as e:
+            return CellError(CellErrorType.TYPE_ERROR, detail = e)
+        return _indirect_string(ctx, str_arg)
+    return indirect
+
+
+@lru_cache(maxsize = 1024)
+def _compile_indirect_string(str_arg):
+    ''' Compiles "=INDIRECT(<str_arg>)". Returns None if it can not be
+        parsed.'''
+    import lark
+    from .formula_grammar import parser
+    try:
+        tree = parser.parse("=INDIRECT(" + str_arg + ")")
+    except lark.exceptions.LarkError:
+        return None
+    # References in the string are not relative to the cell
+    template = FormulaTemplate(None)
+    tagged = _compile_tagged(tree, template)
+    return tagged, template.bind((0, 0))
+
+
+def _indirect_string(ctx, str_arg):
+    ''' Resolves a string argument of INDIRECT by evaluating it as the
+        argument of INDIRECT again.'''
+    compiled = _compile_indirect_string(str_arg)
+    # A string that resolves to itself would recurse forever
+    if compiled is None or str_arg in ctx.indirect_stack:
+        return CellError(CellErrorType.TYPE_ERROR,
+            detail = "INDIRECT requires a cell reference")
+
+    tagged, formula = compiled
+    saved = ctx.refs, ctx.ranges
+    ctx.refs, ctx.ranges = formula.refs, formula.ranges
+    ctx.indirect_stack.append(str_arg)
+    try:
+        is_reference, value = tagged(ctx)
+    except Exception: # pylint: disable=broad-except
+        return CellError(CellErrorType.TYPE_ERROR,
+            detail = "INDIRECT requires a cell reference")
+    finally:
+        ctx.indirect_stack.pop()
+        ctx.refs, ctx.ranges = saved
+
+    #If arg parses to a cell or cell_range, get that value
+    if not is_reference:
+        return CellError(CellErrorType.TYPE_ERROR,
+            detail = "INDIRECT requires a cell reference")
+    return Decimal(0) if value is None else value
+
+
+def _sheet_and_ref(node):
+    ''' Returns the (lowercase sheet name or None, reference) of a cell or
+        cell_range node'''
+    if len(node.children) == 1:
+        return None, str(node.children[0])
+    sheet_tok = node.children[0]
+    sheet_name = str(sheet_tok)
+    if sheet_tok.type == "QUOTED_NAME":
+        sheet_name = sheet_name[1:-1]
+    return sheet_name.lower(), str(node.children[1])
+
+
+def _read_cell(ctx, sheet_name, cell_name, valid):
+    '''Reads the value of a cell, recording it as a parent'''
+    sheet = ctx.wb.sheets.get(sheet_name)
+    if sheet is None:
+        ctx.bad_cells.append((sheet_name, cell_name))
+        return CellError(CellErrorType.BAD_NAME,
+            detail = "{} does not exist".format(sheet_name))
+    if not valid:
+        # This happens if the sheet exists/cell does not exists
+        # which indicates a bad_name error
+        return CellError(CellErrorType.BAD_NAME,
+            detail = "{} invalid cell".format(cell_name))
+
+    ctx.parent_cells.append((sheet_name, cell_name))
+    return sheet.cells.value(cell_name)
+
+
+def _compile_cell(node, template):
+    ''' cell parsing. The cell name is looked up in the (name, valid)
+        references of the bound formula.'''
+    sheet_name, cell_name = _sheet_and_ref(node)
+    index = len(template.cell_slots)
+    template.cell_slots.append(_relative_ref(
+        _CELLREF.fullmatch(cell_name).groups(), template.origin))
+
+    if sheet_name is None:
+        return lambda ctx: _read_cell(ctx, ctx.curr_sheet, *ctx.refs[index])
+    return lambda ctx: _read_cell(ctx, sheet_name, *ctx.refs[index])
+
+
+def _compile_cell_range(node, template, sparse = False):
+    '''Cell range parsing. Returns a list of lists if cell range
+       is valid. If not, returns a BAD_NAME error. Function arguments
+       are compiled with sparse = True and return a CellRange for ranges
+       of existing sheets.'''
+    sheet_name, cell_range = _sheet_and_ref(node)
+    index = len(template.range_slots)
+    template.range_slots.append(tuple(_relative_ref(
+        _CELLREF.fullmatch(corner).groups(), template.origin)
+        for corner in cell_range.split(":")))
+
+    def cell_range_values(ctx):
+        bounds = ctx.ranges[index]
+        if bounds is None:
+            return [[CellError(CellErrorType.BAD_NAME,
+                detail = "Cell range outside of A1:ZZZZ9999")]]
+        rows, cols = bounds
+        name = sheet_name if sheet_name is not None else ctx.curr_sheet
+        # The range is a single dependency, not one per cell
+        ctx.parent_ranges.append((name, (cols[0], rows[0]), (cols[-1], rows[-1])))
+        sheet = ctx.wb.sheets.get(name)
+        if sheet is None:
+            error = CellError(CellErrorType.BAD_NAME,
+                detail = "{} does not exist".format(name))
+            return [[error for col in cols] for row in rows]
+
+        cell_range = CellRange(sheet.cells, rows, cols)
+        return cell_range if sparse else cell_range.grid()
+    return cell_range_values
+
+
+_COMPILERS = {
+    "number": _compile_number,
+    "string": _compile_string,
+    "bool": _compile_bool,
+    "add_expr": _compile_add_expr,
+    "mul_expr": _compile_mul_expr,
+    "unary_op": _compile_unary_op,
+    "concat_expr": _compile_concat_expr,
+    "compare_expr": _compile_compare_expr,
+    "function_expr": _compile_function_expr,
+    "cell": _compile_cell,
+    "cell_range": _compile_cell_range,
+}
@@ -0,0 +1,73 @@
+'''Builds the formula parser once per process.
+
+Compiling formulas.lark into LALR tables is most of the cost of importing
+the package, so the built parser is saved next to the grammar and loaded by
+later processes. The saved parser is only used if it was built from the
+same grammar with the same version of lark.'''
+import hashlib
+import os
+import pickle
+import tempfile
+import lark
+
+GRAMMAR_PATH = os.path.join(os.path.dirname(__file__), 'formulas.lark')
+CACHE_PATH = GRAMMAR_PATH + '.cache'
+# Options that change the built parser are part of the cache key
+PARSER_OPTIONS = {'start': 'formula', 'parser': 'lalr'}
+
+
+def _grammar_hash(grammar):
+    '''Hash of everything the built parser depends on'''
+    key = repr((grammar, lark.__version__, sorted(PARSER_OPTIONS.items())))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _load_cached(grammar_hash, cache_path):
+    ''' Returns the cached parser, or None if there is no cache or it was
+        built from something else.'''
+    try:
+        with open(cache_path, 'rb') as f:
+            if pickle.load(f) != grammar_hash:
+                return None
+            return lark.Lark.load(f)
+    except Exception: # pylint: disable=broad-except
+        # Missing, truncated or incompatible cache: rebuild it
+        return None
+
+
+def _save_cached(parser, grammar_hash, cache_path):
+    ''' Saves the parser to the cache. The file is written under another
+        name and renamed, so concurrent processes never read half a file.
+        An unwritable package directory just means no cache.'''
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(cache_path),
+            prefix = '.formulas-', suffix = '.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(grammar_hash, f)
+            parser.save(f)
+        os.replace(tmp_path, cache_path)
+    except Exception: # pylint: disable=broad-except
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load_parser(grammar_path = GRAMMAR_PATH, cache_path = CACHE_PATH):
+    '''Loads the formula parser from the cache, building it if needed'''
+    with open(grammar_path, encoding = 'utf-8') as f:
+        grammar = f.read()
+    grammar_hash = _grammar_hash(grammar)
+
+    parser = _load_cached(grammar_hash, cache_path)
+    if parser is None:
+        parser = lark.Lark(grammar, **PARSER_OPTIONS)
+        _save_cached(parser, grammar_hash, cache_path)
+    return parser
+
+
+# The parser shared by the whole package
+parser = load_parser()
@@ -5,8 +5,8 @@ from decimal import Decimal, DecimalException
 from .errors import CellError, CellErrorType
 from .cell import get_cell_tuple, get_cell_name
 from .helper_functions import get_empty_bool, compute_bool, compare, convert_to_string, is_error
+from .formula_grammar import parser
 
-parser = lark.Lark.open('formulas.lark', start='formula', rel_to=__file__)
 NON_NUMBERS = [str(Decimal("Infinity")), str(Decimal("Nan")),
     str(Decimal("-Infinity")), str(Decimal("-Nan"))]
 
@@ -1,11 +1,9 @@
 '''Tranformer for renames or move/copy'''
 import lark
-from typing import Tuple
 from lark import Tree, Transformer
 from decimal import Decimal
-import re
+from .cell_address import split_location, column_name
 
-parser = lark.Lark.open('formulas.lark', start='formula', rel_to=__file__)
 NON_NUMBERS = [str(Decimal("Infinity")), str(Decimal("Nan")),
     str(Decimal("-Infinity")), str(Decimal("-Nan"))]
 
@@ -217,7 +215,7 @@ class transform_exp(Transformer):
             connector = "!"
 
         cell_ref = cell_name.replace("$", "").lower()
-        col, row = get_cell_tup(cell_ref)
+        col, row = split_location(cell_ref)
 
         final_cell = ""
 
@@ -228,13 +226,13 @@ class transform_exp(Transformer):
             final_cell = cell_name
         elif cell_name.count("$") == 1:
             if cell_name[0] == "$": # Column absolute only --> change row
-                shifted_col, shifted_row = get_cell_str_tuple((col, row + row_shift))
+                shifted_col, shifted_row = column_name(col), str(row + row_shift)
                 final_cell = "$" + shifted_col + shifted_row
             else: # Row abolute only --> change column
-                shifted_col, shifted_row = get_cell_str_tuple((col + col_shift, row))
+                shifted_col, shifted_row = column_name(col + col_shift), str(row)
                 final_cell = shifted_col + "$" + shifted_row
         else: # Neither absolute --> change both
-            shifted_col, shifted_row = get_cell_str_tuple((col + col_shift, row + row_shift))
+            shifted_col, shifted_row = column_name(col + col_shift), str(row + row_shift)
             final_cell = shifted_col + shifted_row
 
 
@@ -261,39 +259,3 @@ class transform_exp(Transformer):
             c2 = self.cell_shift([c2]).children[0]
             val = sheet_name + connector + c1 + ":" + c2
             return Tree("cell_val", [val])
-
-
-
-
-
-## Helper functions for cell operations
-def get_cell_tup(location: str) -> Tuple[int, int]:
-    '''Converts cell location string to tuple (without checking validity)
-     Split string in to letters and numbers'''
-    location = location.lower()
-    match = re.match(r"([a-z]+)([0-9]+)", location, re.I)
-    if not match:
-        raise ValueError("Invalid cell format.")
-    (col, row) = match.groups()
-    if row[0] == "0":
-        raise ValueError("Invalid cell format.")
-    row = int(row)
-    #Must convert column string (base 26) to integer
-    alph = "abcdefghijklmnopqrstuvwxyz"  # or string.ascii_uppercase
-    alph_index = {char: ind for ind, char in enumerate(alph, 1)}
-    result = 0
-    for char in col.lower():
-        result = result * 26 + alph_index[char]
-    col = result
-
-    return (col, row)
-
-## Helper functions for cell operations
-def get_cell_str_tuple(loc: Tuple[int, int]) -> Tuple[str, str]:
-    ''' Converts cell tuple to location string (without checking vailidity)'''
-    col, row = loc
-    loc_string = ""
-    while col > 0:
-        col, rem = divmod(col - 1, 26)
-        loc_string = chr(65 + rem) + loc_string
-    return loc_string, str(row)
@@ -1,8 +1,9 @@
 '''Functions to be used in sheets'''
 from functools import reduce
-from decimal import Decimal
+from decimal import Decimal, getcontext
 from .errors import CellError, CellErrorType
 from .helper_functions import compare, is_error
+from .cell_range import CellRange, scaled, add_totals
 import sheets
 
 
@@ -192,7 +193,12 @@ def combine_args_into_list(args):
        BAD_NAME errors in cell_ranges.'''
     values = []
     for a in args:
-        if type(a) == list:
+        if type(a) == CellRange:
+            # Only the cells in the sheet are read, see CellRange.values
+            a = a.values()
+            check_bad_name_cell_range(a)
+            values += a
+        elif type(a) == list:
             # We have a nested cell_range list, so we flatten and add values
             a = [val for row in a for val in row]
             check_bad_name_cell_range(a)
@@ -201,15 +207,99 @@ def combine_args_into_list(args):
             values.append(a)
     return values
 
+def count_args(args):
+    '''Number of values in the args, counting every cell of cell ranges'''
+    count = 0
+    for a in args:
+        if type(a) == CellRange:
+            count += a.size()
+        elif type(a) == list:
+            count += sum(len(row) for row in a)
+        else:
+            count += 1
+    return count
+
 def check_bad_name_cell_range(cell_vals):
     '''Throws error if there is an error in the list of cell values'''
     for val in cell_vals:
         if is_error(val, CellErrorType.BAD_NAME):
             raise ValueError("cell range references bad cell")
 
+def add_numbers(args):
+    ''' Adds up args that are numbers, empty cells or ranges of them. The
+        stored numbers of the ranges are added up in their columns instead
+        of one by one. Returns (sum, count), where sum is what sum() of the
+        converted values gives and count is how many numbers there are, or
+        None if an arg has another value, and the values have to be gone
+        through.'''
+    parts = []
+    for a in args:
+        if type(a) == CellRange:
+            part = a.total()
+            if part is None:
+                return None
+            parts.append(part)
+        elif type(a) == Decimal and a.is_finite():
+            parts.append(scaled(a))
+        elif a is not None:
+            return None
+    total, places, absolute, count = add_totals(parts)
+    # Adding the numbers one by one only rounds if a partial sum can have
+    # more digits than the precision
+    if absolute >= 10 ** getcontext().prec:
+        return None
+    return Decimal(total).scaleb(-places), count
+
+def first_extreme(args, op):
+    ''' Returns (value, count) for args that are numbers, empty cells or
+        ranges of them: value is the first smallest (op "<") or largest (op
+        ">") value, with empty cells as 0 like in MIN and MAX, and count is
+        how many numbers there are. The ranges find theirs in the columns of
+        stored numbers. Returns None if an arg has another value.'''
+    found = []
+    count = 0
+    for a in args:
+        if type(a) == CellRange:
+            extreme = a.extreme(op == ">")
+            if extreme is None:
+                return None
+            value, size = extreme
+            count += size
+            if size < a.size() and value is not None:
+                # The empty cells of the range count as 0
+                if value == 0:
+                    # Whether a 0 or an empty cell comes first
+                    value = first_value(a.values(), op)
+                elif not compare(value, Decimal(0), op):
+                    value = None
+            found.append(value)
+        elif type(a) == Decimal and a.is_finite():
+            found.append(a)
+            count += 1
+        elif a is None:
+            found.append(None)
+        else:
+            return None
+    return first_value(found, op), count
+
+def first_value(values, op):
+    '''Returns the first smallest (op "<") or largest (op ">") of values'''
+    first = values[0]
+    for a in values:
+        if compare(a, first, op):
+            first = a
+    return first
+
 
 def MIN(*args):
     '''MIN function'''
+    # Numbers and ranges of numbers are compared without going through each
+    # value
+    found = first_extreme(args, "<") if args else None
+    if found is not None:
+        value, count = found
+        return value if count else 0
+
     args = combine_args_into_list(args)
     if len(args) < 1:
         raise ValueError("MIN needs at least 1 argument.")
@@ -228,6 +318,11 @@ def MIN(*args):
 
 def MAX(*args):
     '''MAX function'''
+    found = first_extreme(args, ">") if args else None
+    if found is not None:
+        value, count = found
+        return value if count else 0
+
     args = combine_args_into_list(args)
     if len(args) < 1:
         raise ValueError("MAX needs at least 1 argument.")
@@ -246,6 +341,13 @@ def MAX(*args):
 
 
 def SUM(*args):
+    # Numbers and ranges of numbers are added up without going through each
+    # value
+    added = add_numbers(args) if args else None
+    if added is not None:
+        total, count = added
+        return total if count else 0
+
     args = combine_args_into_list(args)
     if len(args) < 1:
         raise ValueError("SUM needs least 1 argument.")
@@ -258,6 +360,11 @@ def SUM(*args):
     return sum(args)
 
 def AVERAGE(*args):
+    count = count_args(args)
+    added = add_numbers(args) if args else None
+    if added is not None and added[1]:
+        return added[0]/count
+
     args = combine_args_into_list(args)
     if len(args) < 1:
         raise ValueError("AVERAGE needs at least 1 argument.")
@@ -267,7 +374,7 @@ def AVERAGE(*args):
         return CellError(CellErrorType.DIVIDE_BY_ZERO, detail = 'AVERAGE given empty cells only')
 
     args = [convert_to_number(a) for a in args]
-    return sum(args)/len(args)
+    return sum(args)/count
 
 
 def HLOOKUP(*args):
@@ -279,6 +386,15 @@ def HLOOKUP(*args):
     key = args[0]
     grid = args[1]
 
+    if type(grid) == CellRange:
+        if index < 1 or index > len(grid.rows):
+            raise ValueError("HLOOKUP index out of bounds")
+        # The top row is looked up in an index shared by the lookups into it
+        found_col = grid.lookup(key, vertical = False)
+        if found_col is None:
+            raise ValueError("HLOOKUP key not found in range")
+        return grid.value_at(grid.rows[index - 1], found_col)
+
     if type(grid) != list:
         raise ValueError("HLOOKUP takes cell range as second arg")
     if index < 1 or index > len(grid):
@@ -306,6 +422,16 @@ def VLOOKUP(*args):
     key = args[0]
     grid = args[1]
 
+    if type(grid) == CellRange:
+        if index < 1 or index > len(grid.cols):
+            raise ValueError("VLOOKUP index out of bounds")
+        # The first column is looked up in an index shared by the lookups
+        # into it
+        found_row = grid.lookup(key)
+        if found_row is None:
+            raise ValueError("VLOOKUP key not found in range")
+        return grid.value_at(found_row, grid.cols[index - 1])
+
     if type(grid) != list:
         raise ValueError("VLOOKUP takes cell range as second arg")
     if index < 1 or index > len(grid[0]):
@@ -361,4 +487,7 @@ def get_func_dict():
 
     return func_dict
 
+# Functions that take CellRange arguments; other functions get the grid
+RANGE_FUNCTIONS = [MIN, MAX, SUM, AVERAGE, HLOOKUP, VLOOKUP]
+
 func_dict = get_func_dict()
@@ -101,3 +101,12 @@ def compare(b1, b2, op):
         print("uh oh")
         val = True
     return val
+
+def same_value(a, b):
+    ''' True if two cell values are the same, so that the cells depending
+        on them do not need to be recalculated. Errors are the same if they
+        have the same type; 1 and TRUE, or 1 and 1.0, are different.'''
+    if isinstance(a, CellError) or isinstance(b, CellError):
+        return isinstance(a, CellError) and isinstance(b, CellError) \
+            and a.get_type() == b.get_type()
+    return type(a) == type(b) and a == b and str(a) == str(b)
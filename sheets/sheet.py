@@ -1,16 +1,373 @@
 '''sheet class'''
-from .cell import get_cell_tuple
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+from .cell import Cell
+from .cell_address import get_cell_tuple, get_location, pack_location, \
+    unpack_location, ROW_SHIFT, MAX_ROW
+from .column_store import NumberColumn
+from .column_sums import ColumnSums
+
+# Number of ranges whose totals, of columns whose sums, and of lookup
+# indexes kept by a CellDict
+MAX_TOTALS = 64
+MAX_SUMS = 64
+MAX_LOOKUPS = 64
+
+
+class CellDict(dict):
+    ''' The {location : Cell} dict of a sheet. The cells are also stored by
+        their packed (col, row) coordinates (see cell.pack_location), so
+        that ranges, extents, moves and sorts work on integers instead of
+        location strings. The location strings stay the keys of the dict
+        because the dependency graph and the notifications use them.
+
+        Numbers that no formula refers to directly are not kept as Cells,
+        but in the columns of typed arrays of self.numbers (see
+        store_number and column_store). They are still cells of the dict:
+        "in", iteration and len() include them, and cells[location] or
+        get() turns a number back into a Cell, since the caller may change
+        it. peek() and values_in() read them without doing so.'''
+    def __init__(self):
+        super().__init__()
+        self.positions = {} # {location : packed (col, row)}
+        self.locations = {} # {packed (col, row) : location}
+        self.row_numbers = [] # sorted rows that have cells
+        self.rows = {} # {row : sorted cols that have cells}
+        self.numbers = {} # {col : NumberColumn}
+        self.stored = 0 # numbers stored since the dicts were last compacted
+        self.totals = {} # {(rows, cols) : RangeTotals} of large ranges
+        self.sums = {} # {col : ColumnSums} of columns read by aggregates
+        self.lookups = {} # {(rows, cols) : {value : position}}, see keep_lookup
+
+    def __setitem__(self, location, cell):
+        self.set(location, cell)
+
+    def __contains__(self, location):
+        return dict.__contains__(self, location) or \
+            (bool(self.numbers) and self._number_position(location) is not None)
+
+    def __missing__(self, location):
+        cell = self.peek(location)
+        if cell is None:
+            raise KeyError(location)
+        self.set(location, cell)
+        return cell
+
+    def get(self, location, default = None):
+        cell = dict.get(self, location)
+        if cell is None:
+            if self.numbers and location in self:
+                return self[location]
+            return default
+        return cell
+
+    def __iter__(self):
+        # A list, since getting a number makes it a Cell of the dict, and
+        # setting a cell may store a number
+        locations = list(dict.__iter__(self))
+        for col, column in self.numbers.items():
+            locations.extend(get_location(col, row) for row in column.rows())
+        return iter(locations)
+
+    def __len__(self):
+        return dict.__len__(self) + sum(column.count for column in self.numbers.values())
+
+    def kept_cells(self):
+        ''' Returns a list of the (location, Cell) of the cells kept as
+            Cells. Stored numbers are left out: they have no parents or
+            children, and getting them would make them Cells of the dict.'''
+        return list(dict.items(self))
+
+    def _number_position(self, location, position = None):
+        ''' Returns the (col, row) of a location if it has a stored number.
+            position is the (col, row) of the location if it is known.'''
+        col, row = position if position is not None else get_cell_tuple(location)
+        column = self.numbers.get(col)
+        if column is not None and column.has(row):
+            return col, row
+        return None
+
+    def peek(self, location, position = None):
+        ''' Returns the cell at a location, or None. A stored number is
+            returned as a new Cell that is not kept, so that reading it does
+            not make it a Cell of the dict. position is the (col, row) of the
+            location if it is known.'''
+        cell = dict.get(self, location)
+        if cell is None and self.numbers:
+            position = self._number_position(location, position)
+            if position is not None:
+                value = self.numbers[position[0]].get(position[1])
+                cell = Cell(str(value))
+                cell.value = value
+        return cell
+
+    def value(self, location, position = None):
+        ''' Returns the value of the cell at a location, or None. position
+            is the (col, row) of the location if it is known.'''
+        cell = dict.get(self, location)
+        if cell is not None:
+            return cell.value
+        if self.numbers:
+            position = self._number_position(location, position)
+            if position is not None:
+                return self.numbers[position[0]].get(position[1])
+        return None
+
+    def has_value(self, location, position = None):
+        ''' True if the cell at a location has a value. position is the (col,
+            row) of the location if it is known.'''
+        cell = dict.get(self, location)
+        if cell is not None:
+            return cell.value is not None
+        return bool(self.numbers) and self._number_position(location, position) is not None
+
+    def store_number(self, location, cell, position = None):
+        ''' Stores the cell at a location in the column of numbers instead
+            of as a Cell, if it is a number constant that no formula refers
+            to directly. Returns True if it was stored. position is the (col,
+            row) of the location if it is known.'''
+        value = cell.value
+        if type(value) != Decimal or cell.children:
+            return False
+        text = cell.contents
+        if text != str(value):
+            return False
+        col, row = position if position is not None else get_cell_tuple(location)
+        column = self.numbers.get(col)
+        if column is None:
+            column = NumberColumn()
+            if not column.add(row, text):
+                return False
+            self.numbers[col] = column
+        elif not column.add(row, text):
+            return False
+        if not dict.__contains__(self, location):
+            return True
+        self._remove(location)
+        # Dicts keep their size when items are removed, so they are copied
+        # once many cells have become stored numbers
+        self.stored += 1
+        if self.stored > dict.__len__(self) + 1024:
+            self._compact()
+        return True
+
+    def keep_totals(self, key, totals):
+        ''' Keeps the RangeTotals of the (rows, cols) of a range read by an
+            aggregate, so that they are updated as values change instead of
+            added up again (see value_changed). Only the last MAX_TOTALS
+            ranges are kept.'''
+        if len(self.totals) >= MAX_TOTALS:
+            del self.totals[next(iter(self.totals))]
+        self.totals[key] = totals
+
+    def column_sums(self, col):
+        ''' Returns the ColumnSums of a column, which are kept up to date as
+            its values change (see value_changed). Only the last MAX_SUMS
+            columns keep them.'''
+        sums = self.sums.get(col)
+        if sums is None:
+            if len(self.sums) >= MAX_SUMS:
+                del self.sums[next(iter(self.sums))]
+            sums = ColumnSums(self.cell_values_in(range(1, MAX_ROW + 1),
+                range(col, col + 1)), self.numbers.get(col))
+            self.sums[col] = sums
+        return sums
+
+    def keep_lookup(self, key, index):
+        ''' Keeps the {value : position} index of the (rows, cols) of the
+            first column (or row) of a VLOOKUP (or HLOOKUP) table, until a
+            value in it changes (see value_changed). Only the last
+            MAX_LOOKUPS indexes are kept.'''
+        if len(self.lookups) >= MAX_LOOKUPS:
+            del self.lookups[next(iter(self.lookups))]
+        self.lookups[key] = index
+
+    def value_changed(self, location, old_value, new_value, position = None):
+        ''' Updates what is kept about the values of the sheet after the
+            value at a location changed: the totals of the ranges with the
+            location, and the sums of its column. Ranges whose totals can
+            not be kept up to date (e.g. a cell became text) are dropped, as
+            are the lookup indexes with the location. position is the (col,
+            row) of the location if it is known.'''
+        col, row = position if position is not None \
+            else unpack_location(self.position(location))
+        for key in list(self.lookups):
+            rows, cols = key
+            if row in rows and col in cols:
+                del self.lookups[key]
+        sums = self.sums.get(col)
+        if sums is not None:
+            sums.update(row, old_value, new_value)
+        for key, totals in list(self.totals.items()):
+            rows, cols = key
+            if row in rows and col in cols and \
+                    not totals.update(row, col, old_value, new_value):
+                del self.totals[key]
+
+    def _compact(self):
+        '''Copies the dicts of the cells to give back the room of removed cells'''
+        self.stored = 0
+        cells = list(dict.items(self))
+        dict.clear(self)
+        dict.update(self, cells)
+        self.positions = dict(self.positions)
+        self.locations = dict(self.locations)
+
+    def position(self, location):
+        '''Returns the packed (col, row) of a location'''
+        key = self.positions.get(location)
+        if key is None:
+            key = pack_location(*get_cell_tuple(location))
+        return key
+
+    def set(self, location, cell, position = None):
+        ''' Sets the cell at a location. position is the (col, row) of the
+            location if the caller already has it.'''
+        if not dict.__contains__(self, location):
+            col, row = position if position is not None else get_cell_tuple(location)
+            if self.numbers:
+                column = self.numbers.get(col)
+                if column is not None:
+                    column.remove(row)
+            key = pack_location(col, row)
+            self.positions[location] = key
+            self.locations[key] = location
+            if row not in self.rows:
+                insort(self.row_numbers, row)
+                self.rows[row] = []
+            insort(self.rows[row], col)
+        super().__setitem__(location, cell)
+
+    def __delitem__(self, location):
+        if not dict.__contains__(self, location):
+            position = self._number_position(location) if self.numbers else None
+            if position is None:
+                raise KeyError(location)
+            self.numbers[position[0]].remove(position[1])
+            return
+        self._remove(location)
+
+    def _remove(self, location):
+        '''Removes the Cell at a location from the dict'''
+        dict.__delitem__(self, location)
+        key = self.positions.pop(location)
+        del self.locations[key]
+        col, row = unpack_location(key)
+        cols = self.rows[row]
+        del cols[bisect_left(cols, col)]
+        if not cols:
+            del self.rows[row]
+            self.row_numbers.remove(row)
+
+    def location_at(self, col, row):
+        '''Returns the location of the cell at (col, row), or None'''
+        return self.locations.get(pack_location(col, row))
+
+    def cells_in(self, rows, cols):
+        ''' Yields (row, col, location) for the Cells in a range of rows and
+            columns, row by row. The stored numbers are not included; see
+            locations_in.'''
+        row_numbers = self.row_numbers
+        locations = self.locations
+        start = bisect_left(row_numbers, rows[0])
+        end = bisect_right(row_numbers, rows[-1])
+        left, right = cols[0], cols[-1]
+        for row in row_numbers[start:end]:
+            row_cols = self.rows[row]
+            first = bisect_left(row_cols, left)
+            last = bisect_right(row_cols, right, first)
+            packed_row = row << ROW_SHIFT
+            for col in row_cols[first:last]:
+                yield row, col, locations[packed_row | col]
+
+    def number_columns(self, cols):
+        '''Returns the (col, NumberColumn) of the stored numbers in cols'''
+        if len(self.numbers) < len(cols):
+            return [(col, column) for col, column in self.numbers.items()
+                if cols[0] <= col <= cols[-1]]
+        return [(col, self.numbers[col]) for col in cols if col in self.numbers]
+
+    def locations_in(self, rows, cols):
+        ''' Returns the (row, col, location) of the cells in a range of rows
+            and columns, row by row, stored numbers included'''
+        found = list(self.cells_in(rows, cols))
+        if self.numbers:
+            count = len(found)
+            for col, column in self.number_columns(cols):
+                found.extend((row, col, get_location(col, row))
+                    for row in column.rows(rows[0], rows[-1]))
+            if len(found) > count:
+                found.sort()
+        return found
+
+    def cell_values_in(self, rows, cols):
+        ''' Returns the (row, col, value) of the Cells in a range of rows and
+            columns, row by row, without the stored numbers'''
+        return [(row, col, dict.__getitem__(self, location).value)
+            for row, col, location in self.cells_in(rows, cols)]
+
+    def values_in(self, rows, cols):
+        ''' Returns the (row, col, value) of the cells in a range of rows and
+            columns, row by row, stored numbers included'''
+        found = self.cell_values_in(rows, cols)
+        if self.numbers:
+            count = len(found)
+            for col, column in self.number_columns(cols):
+                found.extend((row, col, column.get(row))
+                    for row in column.rows(rows[0], rows[-1]))
+            if len(found) > count:
+                found.sort(key = _position)
+        return found
+
+
+def _position(found):
+    '''Sort key of the (row, col, value) of values_in'''
+    return found[0], found[1]
+
+
 class Sheet:
     '''Represents the sheets in the Workbook'''
     def __init__(self, name):
         self.name = name
-        self.cells = {}
+        self.cells = CellDict()
+        # The extent is kept up to date as cell values change (see
+        # update_extent), with the number of cells that have a value in each
+        # column and row
+        self.occupied = {} # {packed (col, row) : None} of the cells with a value
+        self.col_counts = {}
+        self.row_counts = {}
+        self.extent = (0, 0)
 
     def get_extent(self):
         '''get extent of sheet'''
-        tuples = \
-        [get_cell_tuple(c) for c in self.cells if self.cells[c].value is not None]
-        if tuples:
-            unzipped = list(zip(*tuples))
-            return(max(unzipped[0]), max(unzipped[1]))
-        return (0,0)
+        return self.extent
+
+    def update_extent(self, location):
+        ''' Updates the extent after the value of the cell at a location
+            may have changed'''
+        key = self.cells.position(location)
+        col, row = unpack_location(key)
+        has_value = self.cells.has_value(location, (col, row))
+        if has_value == (key in self.occupied):
+            return
+
+        max_col, max_row = self.extent
+        if has_value:
+            self.occupied[key] = None
+            self.col_counts[col] = self.col_counts.get(col, 0) + 1
+            self.row_counts[row] = self.row_counts.get(row, 0) + 1
+            self.extent = (max(max_col, col), max(max_row, row))
+            return
+
+        del self.occupied[key]
+        self.col_counts[col] -= 1
+        if not self.col_counts[col]:
+            del self.col_counts[col]
+            if col == max_col:
+                max_col = max(self.col_counts, default = 0)
+        self.row_counts[row] -= 1
+        if not self.row_counts[row]:
+            del self.row_counts[row]
+            if row == max_row:
+                max_row = max(self.row_counts, default = 0)
+        self.extent = (max_col, max_row)
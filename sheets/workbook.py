@@ -4,17 +4,21 @@ from typing import List, Optional, Tuple, Any
 from typing import TextIO, Callable, Iterable
 import re
 import json
-import lark
+import decimal
+from collections import deque
+from contextlib import contextmanager
 import sheets
 from .errors import CellError, CellErrorType
 from .sheet import Sheet
+from .cell_range import CellRange
 from .functions import get_func_dict
-from .cell import Cell, get_cell_tuple, parse_cell_contents, get_cell_name
+from .cell import Cell, NO_CELLS, get_cell_tuple, parse_cell_contents, get_cell_name, \
+    get_location
 from .sorting import rowProxy
-
-
-from .formula_parser import eval_exp
-from .formula_transformer import transform_exp
+from .helper_functions import same_value
+from .dependency_graph import strongly_connected_components, is_cycle, RangeIndex
+# The formula parser, compiler and transformer are imported when they are
+# first needed, so that importing the package stays cheap
 
 
 class Workbook:
@@ -22,18 +26,31 @@ class Workbook:
 
     Any and all operations on a workbook that may affect calculated cell
     values should cause the workbook's contents to be updated properly.'''
-    def __init__(self):
-        '''Initialize a new empty workbook.'''
+    def __init__(self, lazy = False):
+        '''Initialize a new empty workbook.
+
+        In a lazy workbook, set_cell_contents only marks the cells that
+        depend on the cell as out of date, and get_cell_value computes the
+        value of a cell (and of the out of date cells it reads) when it is
+        asked for. Cell change notifications are sent once the changed
+        values are computed.'''
 
         self.sheets = {} # {Sheet names (lowercase keys only) : Sheet objects}
         self.sheet_list = [] # Holds sheet names (lowercase) for order
         self.pre_sheets = {} # hold sheets that don't exist but are referenced
         # Parses formulas
-        self.parser = lark.Lark.open('formulas.lark',
-            start='formula', rel_to=__file__)
+        # Ranges read by formulas, e.g. SUM(A1:A100)
+        self.range_index = RangeIndex()
+        # Compiled formulas shared by cells with the same relative formula
+        self.formula_templates = {} # {formula_key : FormulaTemplate}
         self.notify_functions = [] # hold notify functions
         self.functions = get_func_dict()
         self.update_dict = {}
+        self.lazy = lazy
+        # Out of date cells of a lazy workbook or of a batch:
+        # {(sheet, cell) : True if its formula was set since it was evaluated}
+        self.dirty = {}
+        self.batch_depth = 0 # number of batch() blocks the workbook is in
 
     def num_sheets(self) -> int:
         '''Return the number of spreadsheets in the workbook.'''
@@ -117,6 +134,9 @@ class Workbook:
                 # by not instantiating it
                 pass
 
+        # And the formulas reading ranges of the new sheet
+        self._update_range_consumers(sheet_name.lower())
+
         return len(self.sheets) - 1, sheet_name
 
     def del_sheet(self, sheet_name: str) -> None:
@@ -132,29 +152,99 @@ class Workbook:
 
         del_sheet = self.sheets[sheet_name.lower()]
         del self.sheets[sheet_name.lower()]
+        # The cells of the sheet stop being updated
+        del_sheet.cells.totals.clear()
+        del_sheet.cells.sums.clear()
+        del_sheet.cells.lookups.clear()
 
         self.pre_sheets[sheet_name.lower()] = del_sheet
+        # The cells of the sheet are no longer computed
+        self.dirty = {key: formula_set for key, formula_set in self.dirty.items()
+            if key[0] != sheet_name.lower()}
 
-        for cell in del_sheet.cells:
+        for cell, cell_obj in del_sheet.cells.kept_cells():
             # Update the children of the cells in the now-deleted sheet
-            children = del_sheet.cells[cell].children
+            children = list(cell_obj.children)
             for c_sheet, c_name in children:
                 # Only update children in active sheet
                 if c_sheet in self.sheets:
                     child = self.sheets[c_sheet].cells[c_name]
                     self.set_cell_contents(c_sheet, c_name, child.contents, update_cell = True)
+        self._update_range_consumers(sheet_name.lower())
 
         self.sheet_list.remove(sheet_name.lower())
 
-    def _get_formula_new_sheet(self, contents, old_sheet, new_sheet):
-        ''' Transforms fomula contents to have new_sheet instead of old_sheet.'''
-
+    def _update_range_consumers(self, sheet_name):
+        ''' Re-sets the formulas that read ranges of a sheet that was just
+            created or deleted (formulas in the sheet itself are skipped).'''
+        for c_sheet, c_cell in self.range_index.sheet_consumers(sheet_name):
+            if c_sheet != sheet_name and c_sheet in self.sheets \
+                    and c_cell in self.sheets[c_sheet].cells:
+                child = self.sheets[c_sheet].cells[c_cell]
+                self.set_cell_contents(c_sheet, c_cell, child.contents, update_cell = True)
+
+    @property
+    def parser(self):
+        ''' The formula parser shared by every workbook. It is loaded the
+            first time a formula is parsed, so workbooks that only hold
+            values never import lark.'''
+        from .formula_grammar import parser
+        return parser
+
+    def _parse_formula(self, contents):
+        ''' Parses formula contents and returns the tree, or None if the
+            formula can not be parsed.'''
+
+        import lark
         try:
-            tree = self.parser.parse(contents)
+            return self.parser.parse(contents)
         except lark.exceptions.LarkError:
+            return None
+
+    def _set_formula(self, cell, location, prev_cell = None, position = None):
+        ''' Compiles the formula of the cell at location. Formulas that only
+            differ by the shift of their relative references (e.g. a formula
+            filled down a column) share one compiled template, which is bound
+            to the location of each cell. Re-setting a cell to the same
+            contents keeps the previous tree and compiled formula. position
+            is the (col, row) of the location if it is known.'''
+
+        if prev_cell is not None and prev_cell.contents == cell.contents \
+                and prev_cell.formula is not None:
+            cell.tree = prev_cell.tree
+            cell.formula = prev_cell.formula
+            return
+
+        from .formula_compiler import FormulaTemplate, formula_key
+        anchor = position if position is not None else get_cell_tuple(location)
+        key = formula_key(cell.contents, anchor)
+        template = self.formula_templates.get(key)
+        if template is None:
+            cell.tree = self._parse_formula(cell.contents)
+            template = FormulaTemplate(cell.tree, anchor)
+            self.formula_templates[key] = template
+        cell.formula = template.bind(anchor)
+
+    def _evaluate_formula(self, cell, sheet_name):
+        ''' Sets the value of a formula cell using its compiled formula, and
+            returns the evaluation context holding the cells that were read.'''
+
+        from .formula_compiler import EvalContext
+        ctx = EvalContext(self, sheet_name)
+        cell.value = cell.formula.evaluate(ctx)
+        return ctx
+
+    def _get_formula_new_sheet(self, contents, old_sheet, new_sheet, tree = None):
+        ''' Transforms fomula contents to have new_sheet instead of old_sheet.
+            Uses the cached parse tree of the cell if it is given.'''
+
+        if tree is None:
+            tree = self._parse_formula(contents)
+        if tree is None:
             # Don't touch unparseable formulas
             return contents
         # Update formula
+        from .formula_transformer import transform_exp
         evaluator = transform_exp(old_sheet = old_sheet, new_sheet = new_sheet)
         final_eval = evaluator.transform(tree)
         return "=" + final_eval.children[0]
@@ -184,78 +274,105 @@ class Workbook:
             raise KeyError("Sheet {} not in workbook.".format(sheet_name))
         new_sheet_name = self._get_new_sheet_name(new_sheet_name)
 
-        # Update dictionary and delete old sheet key
-        sheet = self.sheets[sheet_name.lower()]
-        self.sheets[new_sheet_name.lower()] = sheet
-        sheet.name = new_sheet_name
-        del self.sheets[sheet_name.lower()]
-
-        # Update sheet list
-        self.sheet_list[self.sheet_list.index(sheet_name.lower())] = new_sheet_name.lower()
-
-        #Process:
-        # 1. Go through all cells of sheet
-        #  - Update contents (get new contents): replace sheet names
-        #  - delete children in same sheet (they will be added later), delete all parents
-        #  - Update contents of out-of sheet children (in sheet children will be updated in loop)
-        #    - Update both formula and parents
-
-        # 2. Set cell value for every cell in sheet
-        #    - set cell value to contents - will update its children as well
-        #    - will also add children to parents in same sheet
-        for cell in sheet.cells:
-            curr_cell = sheet.cells[cell]
-            if curr_cell.is_formula and sheet_name.lower() in curr_cell.contents.lower():
-
-                # Update formula contents if necessary
-                new_formula = self._get_formula_new_sheet(curr_cell.contents, sheet_name, \
-                        new_sheet_name)
-                curr_cell.contents = new_formula
-
-            # Delete children in same sheet, they will be added later when setting values
-            curr_cell.children = [(s_name, cell) for s_name, cell in \
-                curr_cell.children if s_name != sheet_name.lower()]
-            curr_cell.parents = []
-
-            for c_sheet, c_cell in curr_cell.children:
-                try:
-                    child_cell = self.sheets[c_sheet].cells[c_cell]
-                except KeyError:
-                    continue # Dead child -- we should deal with this in del_sheet()
-                if child_cell.is_formula:
-                    # Update formula contents and child's parents to have renamed sheet
-                    new_formula = self._get_formula_new_sheet(child_cell.contents, \
-                            sheet_name, new_sheet_name)
-
-                    child_cell.contents = new_formula
-                    child_cell.parents = [(s_name, cell) if s_name != sheet_name.lower() else \
-                        (new_sheet_name.lower(), cell) for s_name, cell in child_cell.parents ]
-
-
-        # Update value of all cells in sheets
-        # This will 1) connect children to parents ands 2) update children in other sheets
-        for cell in sheet.cells:
-            curr_cell = sheet.cells[cell]
-            self.set_cell_contents(new_sheet_name, cell, curr_cell.contents, bulk_op = True)
-
-
-        # Deal with cells that referenced the new name sheet before they were new
-        if new_sheet_name.lower() in self.pre_sheets:
-            for cell in self.pre_sheets[new_sheet_name.lower()].cells:
-                cell_obj= self.pre_sheets[new_sheet_name.lower()].cells[cell]
-                for c_sheet, c_cell in cell_obj.children:
+        # Cells waiting for a recalculation or a notification follow the sheet
+        old_name, new_name = sheet_name.lower(), new_sheet_name.lower()
+        self.dirty = {(new_name if s == old_name else s, c): v \
+            for (s, c), v in self.dirty.items()}
+        self.update_dict = {(new_name if s == old_name else s, c): v \
+            for (s, c), v in self.update_dict.items()}
+
+        # Every cell of the sheet is set again; recalculate once at the end
+        with self.batch():
+            # Update dictionary and delete old sheet key
+            sheet = self.sheets[sheet_name.lower()]
+            self.sheets[new_sheet_name.lower()] = sheet
+            sheet.name = new_sheet_name
+            del self.sheets[sheet_name.lower()]
+
+            # Update sheet list
+            self.sheet_list[self.sheet_list.index(sheet_name.lower())] = new_sheet_name.lower()
+
+            # Formulas reading ranges of the sheet, and of the new name before it
+            # existed. The ranges follow the sheet to its new name.
+            range_consumers = self.range_index.sheet_consumers(sheet_name.lower())
+            new_name_consumers = self.range_index.sheet_consumers(new_sheet_name.lower())
+            self.range_index.rename_sheet(sheet_name.lower(), new_sheet_name.lower())
+
+            #Process:
+            # 1. Go through all cells of sheet
+            #  - Update contents (get new contents): replace sheet names
+            #  - delete children in same sheet (they will be added later), delete all parents
+            #  - Update contents of out-of sheet children (in sheet children will be updated in loop)
+            #    - Update both formula and parents
+
+            # 2. Set cell value for every cell in sheet
+            #    - set cell value to contents - will update its children as well
+            #    - will also add children to parents in same sheet
+            for cell, curr_cell in sheet.cells.kept_cells():
+                if curr_cell.is_formula and sheet_name.lower() in curr_cell.contents.lower():
+
+                    # Update formula contents if necessary
+                    new_formula = self._get_formula_new_sheet(curr_cell.contents, sheet_name, \
+                            new_sheet_name, tree = curr_cell.tree)
+                    curr_cell.contents = new_formula
+                    self._set_formula(curr_cell, cell)
+
+                # Delete children in same sheet, they will be added later when setting values
+                curr_cell.children = {(s_name, cell): None for s_name, cell in \
+                    curr_cell.children if s_name != sheet_name.lower()} or NO_CELLS
+                curr_cell.parents = NO_CELLS
+
+                for c_sheet, c_cell in curr_cell.children:
                     try:
                         child_cell = self.sheets[c_sheet].cells[c_cell]
-                        if child_cell.is_formula:
-                            # Update formula contents and child's parents to have renamed sheet
-                            new_formula = self._get_formula_new_sheet(child_cell.contents, \
-                                    sheet_name, new_sheet_name)
-                            self.set_cell_contents(c_sheet, c_cell, new_formula, bulk_op = True, update_cell = True)
-
                     except KeyError:
-                        continue
-
-        self._process_update_dict()
+                        continue # Dead child -- we should deal with this in del_sheet()
+                    if child_cell.is_formula:
+                        # Update formula contents and child's parents to have renamed sheet
+                        new_formula = self._get_formula_new_sheet(child_cell.contents, \
+                                sheet_name, new_sheet_name, tree = child_cell.tree)
+
+                        child_cell.contents = new_formula
+                        self._set_formula(child_cell, c_cell)
+                        child_cell.parents = {(s_name, cell) if s_name != sheet_name.lower() else \
+                            (new_sheet_name.lower(), cell): None for s_name, cell in child_cell.parents}
+
+            # Update formula contents of range consumers in other sheets
+            for c_sheet, c_cell in range_consumers:
+                if c_sheet == sheet_name.lower() or c_sheet not in self.sheets \
+                        or c_cell not in self.sheets[c_sheet].cells:
+                    continue
+                child_cell = self.sheets[c_sheet].cells[c_cell]
+                if child_cell.is_formula:
+                    child_cell.contents = self._get_formula_new_sheet(child_cell.contents, \
+                            sheet_name, new_sheet_name, tree = child_cell.tree)
+                    self._set_formula(child_cell, c_cell)
+
+
+            # Update value of all cells in sheets
+            # This will 1) connect children to parents ands 2) update children in other sheets
+            for cell, curr_cell in sheet.cells.kept_cells():
+                self.set_cell_contents(new_sheet_name, cell, curr_cell.contents, bulk_op = True)
+
+
+            # Deal with cells that referenced the new name sheet before they were new
+            if new_sheet_name.lower() in self.pre_sheets:
+                for cell, cell_obj in self.pre_sheets[new_sheet_name.lower()].cells.kept_cells():
+                    for c_sheet, c_cell in list(cell_obj.children):
+                        try:
+                            child_cell = self.sheets[c_sheet].cells[c_cell]
+                            if child_cell.is_formula:
+                                # Update formula contents and child's parents to have renamed sheet
+                                new_formula = self._get_formula_new_sheet(child_cell.contents, \
+                                        sheet_name, new_sheet_name, tree = child_cell.tree)
+                                self.set_cell_contents(c_sheet, c_cell, new_formula, bulk_op = True, update_cell = True)
+
+                        except KeyError:
+                            continue
+            for c_sheet, c_cell in new_name_consumers:
+                if c_sheet in self.sheets and c_cell in self.sheets[c_sheet].cells:
+                    child_cell = self.sheets[c_sheet].cells[c_cell]
+                    self.set_cell_contents(c_sheet, c_cell, child_cell.contents, bulk_op = True, update_cell = True)
 
     def move_sheet(self, sheet_name: str, index: int) -> None:
         '''Move the specified sheet to the specified index in the workbook's
@@ -316,7 +433,7 @@ class Workbook:
 
         # Go through and set cells in new sheet as the old ones
         for cell in self.sheets[sheet_name.lower()].cells:
-            old_cell = self.sheets[sheet_name.lower()].cells[cell]
+            old_cell = self.sheets[sheet_name.lower()].cells.peek(cell)
             self.set_cell_contents(new_name, cell, old_cell.contents)
 
         return (len(self.sheet_list)-1, new_name)
@@ -333,7 +450,44 @@ class Workbook:
 
         if sheet_name.lower() not in self.sheets:
             raise KeyError("Sheet {} not in workbook.".format(sheet_name))
-        return self.sheets[sheet_name.lower()].get_extent()
+        # Out of date formulas may be empty or not once they are computed
+        sheet_name = sheet_name.lower()
+        if self.dirty:
+            self._settle([key for key in self.dirty if key[0] == sheet_name])
+        if self.update_dict:
+            self._process_update_dict()
+        sheet = self.sheets[sheet_name]
+        if self.batch_depth:
+            # The changes of a batch are only processed at its end
+            for key in self.update_dict:
+                if key[0] == sheet_name:
+                    sheet.update_extent(key[1])
+        return sheet.get_extent()
+
+    @contextmanager
+    def batch(self):
+        '''Context manager that defers recalculation to the end of a block:
+
+            with wb.batch():
+                wb.set_cell_contents("Sheet1", "A1", "5")
+                wb.set_cell_contents("Sheet1", "A2", "=A1 * 2")
+
+        Inside the block, setting a cell only records its contents and the
+        cells it reads, and marks its descendants out of date. When the
+        outermost block exits, the out of date cells are evaluated once, in
+        topological order, and the notification functions are called once
+        with every cell that changed. Reading a value inside the block
+        computes it. Blocks may be nested. Every cell of a cycle found at the
+        end of a block is a circular reference.'''
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                if not self.lazy:
+                    self._settle(list(self.dirty))
+                self._process_update_dict()
 
     def set_cell_contents(self, sheet_name: str, location: str,
                           contents: Optional[str], bulk_op = False, update_cell = False) -> None:
@@ -368,51 +522,151 @@ class Workbook:
         if not update_cell and contents == self.get_cell_contents(sheet_name, location):
             return None
 
-        #self.update_dict = {}
+        old_value = self._stored_value(sheet_name, location)
+        self._set_cell(sheet_name, location, contents, old_value, bulk_op)
+
+    def set_cells_contents(self, sheet_name, cell_contents = None) -> None:
+        '''Set the contents of many cells at once, either of one sheet:
+
+            wb.set_cells_contents("Sheet1", {"A1": "5", "A2": "=A1 * 2"})
+
+        or of any sheets, given an iterable of (sheet name, location,
+        contents) tuples:
+
+            wb.set_cells_contents([("Sheet1", "A1", "5"),
+                                   ("Sheet2", "B1", "=Sheet1!A1")])
+
+        Every sheet name and location is checked before any cell is set: if
+        a sheet name is not found a KeyError is raised, and if a cell
+        location is invalid a ValueError is raised, and no cell is changed.
+        The cells are then set in order as by set_cell_contents, in a
+        batch(): the workbook is recalculated once, and the notification
+        functions are called once.'''
+        if cell_contents is None:
+            cells = sheet_name
+        else:
+            cells = ((sheet_name, location, contents)
+                for location, contents in cell_contents.items())
+
+        # Check everything before changing anything
+        checked = []
+        sheet_keys = {} # {sheet name as given : lowercase sheet name}
+        for name, location, contents in cells:
+            sheet_key = sheet_keys.get(name)
+            if sheet_key is None:
+                sheet_key = name.lower()
+                if sheet_key not in self.sheets:
+                    raise KeyError("Sheet {} not in workbook.".format(name))
+                sheet_keys[name] = sheet_key
+            location = location.lower()
+            checked.append((sheet_key, location, contents, get_cell_tuple(location)))
+
+        self._set_cells(checked)
+
+    def _set_cells(self, cells):
+        ''' Sets the contents of cells in a batch, skipping the ones that do
+            not change. The cells are (lowercase sheet name, lowercase
+            location, contents, (col, row)) tuples that were already
+            checked.'''
+        with self.batch():
+            for sheet_key, location, contents, position in cells:
+                cell = self.sheets[sheet_key].cells.peek(location, position)
+                if cell is None:
+                    if contents is None:
+                        continue
+                    self._set_cell(sheet_key, location, contents, None, True, position)
+                elif contents != cell.contents:
+                    self._set_cell(sheet_key, location, contents, cell.value, True,
+                        position)
+
+    def _set_cell(self, sheet_name, location, contents, old_value, bulk_op,
+            position = None):
+        ''' Sets the contents of a cell after set_cell_contents checked the
+            lowercase sheet name and location. old_value is the value of the
+            cell before it is set, and position the (col, row) of the
+            location if it is known.'''
         if (sheet_name, location) not in self.update_dict:
-            self.update_dict[(sheet_name, location)] = [self.get_cell_value(sheet_name, location)]
+            self.update_dict[(sheet_name, location)] = [old_value]
         else:
-            self.update_dict[(sheet_name, location)].append(self.get_cell_value(sheet_name, location))
+            self.update_dict[(sheet_name, location)].append(old_value)
 
         # Store the previous cell (for children transfer)
-        prev_cell = None
-        if location.lower() in self.sheets[sheet_name].cells:
-            prev_cell = self.sheets[sheet_name].cells[location]
+        prev_cell = self.sheets[sheet_name].cells.peek(location, position)
 
 
         # Create the new cell (which sets the contents), carry over children,
         # add to sheet
         new_cell = Cell(contents = contents)
         if prev_cell is not None:
-            new_cell.children = prev_cell.children[:]
-        self.sheets[sheet_name].cells[location] = new_cell
+            # The previous cell is replaced, so it can hand over its set
+            new_cell.children = prev_cell.children
 
         ################### VALUE SETTING ############
         # Set initial value (set to either number or string)
         new_cell.value = parse_cell_contents(new_cell.contents)
-        bad_cells = []
+
+        # Numbers that no formula refers to are kept in the columns of the
+        # sheet instead of as cells. A number that replaces a formula is
+        # only stored once the formula's dependencies are removed.
+        cells = self.sheets[sheet_name].cells
+        stored = (prev_cell is None or not prev_cell.is_formula) \
+            and cells.store_number(location, new_cell, position)
+        if not stored:
+            cells.set(location, new_cell, position)
+
+        # Parse and compile the formula once; it is reused by every
+        # recalculation, move, rename and sort.
         if new_cell.is_formula:
-            try:
-                tree = self.parser.parse(new_cell.contents)
-                # create evaluator object (that has access to current wb)
-                evaluator = eval_exp(wb = self, curr_sheet = sheet_name)
-                final_eval = evaluator.transform(tree)
-                new_cell.value = final_eval.children[0]
-                # If the value is a cell_range object (list of lists), it is TYPE_ERR0R
-                if type(new_cell.value) == list:
-                    new_cell.value = CellError(CellErrorType.TYPE_ERROR, detail =
-                    "function received cell range")
-
-                new_cell.parents = list(set(evaluator.parent_cells))
-                # cells that are in a nonexistent sheet
-                bad_cells = list(set(evaluator.bad_cells))
-
-
-            except lark.exceptions.LarkError as e:
-                # Indicates that the formula cannot be parsed
-                new_cell.value = CellError(CellErrorType.PARSE_ERROR,
-                    detail = "Can not parse {}".format(contents))
-                #raise e
+            self._set_formula(new_cell, location, prev_cell, position)
+
+        evaluator = None
+        if new_cell.is_formula:
+            # Until it is evaluated, the formula has the value of the cell it
+            # replaces, so that totals of ranges read while evaluating it
+            # (which may hold the cell) see the value _value_changed takes away
+            new_cell.value = prev_cell.value if prev_cell is not None else None
+            evaluator = self._evaluate_formula(new_cell, sheet_name)
+        self._value_changed((sheet_name, location),
+            prev_cell.value if prev_cell is not None else None, new_cell.value,
+            position)
+        self._update_dependencies(sheet_name, location, new_cell, evaluator,
+            prev_cell.parents if prev_cell is not None else {})
+
+        if self.lazy or self.batch_depth:
+            # The value is computed when it is asked for or at the end of
+            # the batch; until then its descendants are out of date, and so
+            # is the cell if it read cells that are out of date
+            up_to_date = not self.dirty or \
+                not self._dirty_parents((sheet_name, location), new_cell)
+            self._mark_dirty(sheet_name, location, new_cell, up_to_date)
+            if (sheet_name, location) not in self.dirty:
+                self.update_dict[(sheet_name, location)].append(new_cell.value)
+        else:
+            ## Update descendants in topological order (this also finds out
+            ## whether the cell is part of a circular dependency)
+            self._recalculate(sheet_name, location, new_cell)
+            self.update_dict[(sheet_name, location)].append(new_cell.value)
+
+        if not stored:
+            cells.store_number(location, new_cell, position)
+
+        if bulk_op == False:
+            self._process_update_dict()
+
+    def _update_dependencies(self, sheet_name, location, cell, evaluator, old_parents):
+        ''' Records the cells and ranges read by the evaluation of a cell in
+            the dependency graph, and removes the edges from old_parents it
+            no longer reads. evaluator is None if the cell is not a formula.'''
+        # The same key is stored as a child of every parent
+        key = (sheet_name, location)
+        bad_cells = {}
+        parent_ranges = []
+        if evaluator is not None:
+            cell.parents = dict.fromkeys(evaluator.parent_cells) or NO_CELLS
+            # cells that are in a nonexistent sheet
+            bad_cells = dict.fromkeys(evaluator.bad_cells)
+            parent_ranges = evaluator.parent_ranges
+        self.range_index.set_ranges(key, parent_ranges)
 
         ### TAKE care of cells in nonexistent sheets
         for b_sheet, b_cell in bad_cells:
@@ -431,157 +685,356 @@ class Workbook:
                 new_bad_cell = non_sheet.cells[b_cell]
 
             # Add the current cell to the children of the bad cell
-            new_bad_cell.children.append((sheet_name, location))
-            new_bad_cell.children = list(set(new_bad_cell.children))
-        new_cell.bad_parents = bad_cells
+            new_bad_cell.add_child(key)
+        if bad_cells:
+            cell.bad_parents = bad_cells
 
         ## Update children of parents
-        for p_sheet, p_cell in new_cell.parents:
+        for p_sheet, p_cell in cell.parents:
             if p_cell.lower() not in self.sheets[p_sheet.lower()].cells:
                 self.sheets[p_sheet.lower()].cells[p_cell.lower()] = \
                     Cell(contents = None)
             parent_cell = self.sheets[p_sheet.lower()].cells[p_cell.lower()]
-            parent_cell.children.append((sheet_name, location))
-            #remove duplicates
-            parent_cell.children = list(set(parent_cell.children))
+            parent_cell.add_child(key)
 
         ## Remove current cell from cells that are no longer parents (dead parents)
-        if prev_cell is not None:
-            dead_parents = list(set(prev_cell.parents) - set(new_cell.parents) - set(bad_cells))
-            for p_sheet, p_cell in dead_parents:
-                if p_cell.lower() not in self.sheets[p_sheet.lower()].cells:
-                    self.sheets[p_sheet.lower()].cells[p_cell.lower()] = \
-                        Cell(contents = None)
-                parent_cell = self.sheets[p_sheet.lower()].cells[p_cell.lower()]
-                parent_cell.children.remove((sheet_name, location))
-
-
-
-        ## Check for circular dependency, get list of descendants
-        circ_dep = False
-        desc = []
-        queue = [(sheet_name, location)]
-        while queue != []:
-            #print("detection bfs")
-            curr_cell = queue.pop(0)
-            sheet, cell = curr_cell
-            try:
-                child = self.sheets[sheet.lower()].cells[cell]
-            except KeyError:
-                # Child in nonexistent sheet (Dead child), so continue
-                # when we delete a sheet, just delete cells from parents
-                continue
-
-            if isinstance(child.value, CellError):
-                if child.value.get_type() == CellErrorType.CIRCULAR_REFERENCE:
-                # If we run into circular reference
+        dead_parents = [parent for parent in old_parents \
+            if parent not in cell.parents and parent not in bad_cells]
+        for p_sheet, p_cell in dead_parents:
+            if p_cell.lower() not in self.sheets[p_sheet.lower()].cells:
+                self.sheets[p_sheet.lower()].cells[p_cell.lower()] = \
+                    Cell(contents = None)
+            parent_cell = self.sheets[p_sheet.lower()].cells[p_cell.lower()]
+            parent_cell.remove_child(key)
+            if not parent_cell.children and (p_sheet, p_cell) != key:
+                self.sheets[p_sheet.lower()].cells.store_number(p_cell.lower(), parent_cell)
+
+    def _live_cell(self, key):
+        ''' Returns the Cell of a (sheet, cell) key, or None if the cell or
+            its sheet no longer exists (a dead child)'''
+        sheet = self.sheets.get(key[0].lower())
+        if sheet is None:
+            return None
+        return sheet.cells.get(key[1])
+
+    def _children(self, key, cell):
+        ''' Returns the cells that depend on a cell: the formulas that
+            reference it directly, then the ones reading a range with it'''
+        if not self.range_index.ranges:
+            return cell.children
+        children = dict(cell.children)
+        for consumer in self.range_index.consumers(key[0], get_cell_tuple(key[1])):
+            children[consumer] = None
+        return children
+
+    def _recalculate_cell(self, key, cell):
+        ''' Re-evaluates a descendant of an updated cell, recording its
+            values for notifications. Returns True if its value changed.'''
+        if key not in self.update_dict:
+            self.update_dict[key] = [cell.value]
+        old_val = cell.value
+        if cell.is_formula:
+            self._evaluate_formula(cell, key[0])
+            self._value_changed(key, old_val, cell.value)
+        self.update_dict[key].append(cell.value)
+        return not same_value(old_val, cell.value)
+
+    def _value_changed(self, key, old_value, new_value, position = None):
+        ''' Updates the totals, sums and lookup indexes kept by the sheet of
+            a cell (see CellDict.value_changed) after the value of the cell
+            changed. position is the (col, row) of the cell if it is known.'''
+        cells = self.sheets[key[0]].cells
+        if (cells.totals or cells.sums or cells.lookups) and old_value is not new_value:
+            cells.value_changed(key[1], old_value, new_value, position)
+
+    def _recalculate(self, sheet_name, location, cell):
+        ''' Updates the descendants of a cell after its value was set.
+
+            The descendants are collected first and evaluated in topological
+            order (Kahn's algorithm): a cell is evaluated once, after all of
+            its parents are final, and only if one of them changed value.
+            Cells that are never ready are in or after a cycle; see
+            _recalculate_cycles.'''
+        root = (sheet_name, location)
+        # A cell without parents (e.g. a constant) can not be in a cycle
+        can_cycle = bool(cell.parents) or self.range_index.has_ranges(root)
+
+        # Collect the descendants and their live children
+        cells = {root: cell}
+        children = {}
+        stack = [root]
+        while stack:
+            key = stack.pop()
+            live = []
+            for child in self._children(key, cells[key]):
+                if child == root and not can_cycle:
                     continue
-
-            if desc != [] and curr_cell == desc[0]:
-                # Circular dependency: we reached the current cell again
-                circ_dep = True
-                break
-
-            desc.append(curr_cell)
-            queue += self.sheets[curr_cell[0]].cells[curr_cell[1]].children
-
-            # Wan't to remove duplicates in queue.
-            queue = list(dict.fromkeys(queue))
-
-
-        ## Update value of current cell if circular dependency
-        if circ_dep:
-            new_cell.value = CellError(CellErrorType.CIRCULAR_REFERENCE,
+                if child not in cells:
+                    child_cell = self._live_cell(child)
+                    if child_cell is None:
+                        continue
+                    cells[child] = child_cell
+                    stack.append(child)
+                live.append(child)
+            children[key] = live
+
+        # Number of parents of each cell that are not final yet
+        in_degree = dict.fromkeys(cells, 0)
+        for live in children.values():
+            for child in live:
+                in_degree[child] += 1
+
+        # The root was just evaluated. If it has a parent among its
+        # descendants it is in a cycle, and nothing is ready. Only then is
+        # there a cycle to check for.
+        if in_degree[root] and self._reaches_itself(root, cells, children):
+            old_val = cells[root].value
+            cells[root].value = CellError(CellErrorType.CIRCULAR_REFERENCE,
                 detail = "Circ. ref")
-
-        self.update_dict[(sheet_name, location)].append(new_cell.value)
-
-        ## Update descendants using BFS
-        queue = new_cell.children[:]
-        while queue != []:
-            #print("update bfs")
-            curr_cell = queue.pop(0)
-            sheet, cell = curr_cell
-
-            # If we reach the current cell again, ignore it
-            if curr_cell == (sheet_name, location):
+            self._value_changed(root, old_val, cells[root].value)
+
+        dirty = {root} # cells with a parent that changed (or the root)
+        queue = deque([root] if in_degree[root] == 0 else [])
+        while queue:
+            key = queue.popleft()
+            del in_degree[key]
+            if key == root or key in dirty and self._recalculate_cell(key, cells[key]):
+                dirty.update(children[key])
+            for child in children[key]:
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    queue.append(child)
+
+        if in_degree:
+            self._recalculate_cycles(root, in_degree, cells, children, dirty)
+
+    def _reaches_itself(self, root, cells, children):
+        ''' True if the root cell is a circular reference: it can be reached
+            from its children without going through cells that already are
+            circular references (so a formula like IFERROR(B1, 0) that
+            catches a cycle it is placed into keeps its value).'''
+        def is_circular(key):
+            return isinstance(cells[key].value, CellError) and \
+                cells[key].value.get_type() == CellErrorType.CIRCULAR_REFERENCE
+
+        if is_circular(root):
+            return False
+        seen = set()
+        stack = list(children[root])
+        while stack:
+            key = stack.pop()
+            if key == root:
+                return True
+            if key in seen or is_circular(key):
                 continue
-            try:
-                child = self.sheets[sheet.lower()].cells[cell]
-            except KeyError:
-                # Dead child, so ignore
+            seen.add(key)
+            stack.extend(children[key])
+        return False
+
+    def _recalculate_cycles(self, root, remaining, cells, children, dirty):
+        ''' Updates the descendants left over by _recalculate, which are in
+            cycles or depend on a cycle. Every cell of a cycle is a circular
+            reference; the others are evaluated in topological order.'''
+        for component in strongly_connected_components(remaining, children):
+            if not dirty.intersection(component):
                 continue
+            if is_cycle(component, children):
+                for key in component:
+                    # Whether the root is a circular reference was decided
+                    # by _reaches_itself; its dependents still have to be
+                    # updated
+                    if key == root:
+                        dirty.update(children[key])
+                        continue
+                    if key not in self.update_dict:
+                        self.update_dict[key] = [cells[key].value]
+                    old_val = cells[key].value
+                    cells[key].value = CellError(CellErrorType.CIRCULAR_REFERENCE,
+                        detail = "Circ. ref detected")
+                    self._value_changed(key, old_val, cells[key].value)
+                    self.update_dict[key].append(cells[key].value)
+                    if not same_value(old_val, cells[key].value):
+                        dirty.update(children[key])
+            elif self._recalculate_cell(component[0], cells[component[0]]):
+                dirty.update(children[component[0]])
+
+    def _mark_dirty(self, sheet_name, location, cell, up_to_date):
+        ''' Marks the descendants of a cell that was just set as out of date,
+            and the cell itself unless its value is up_to_date (lazy
+            workbooks and batches). The descendants of an out of date cell
+            are already out of date, so the search stops at them.'''
+        root = (sheet_name, location)
+        if cell.is_formula and not up_to_date:
+            self.dirty[root] = True
+        else:
+            self.dirty.pop(root, None)
 
-            # Fill cell update dictionary with initial value of descendent
-            if (sheet.lower(), cell.lower()) not in self.update_dict:
-                self.update_dict[sheet.lower(), cell.lower()] = [child.value]
-
-
-            # Check to see if it was previously a circular ref error
-            was_error = False
-            if isinstance(child.value, CellError):
-                if child.value.get_type() == CellErrorType.CIRCULAR_REFERENCE:
-                    was_error = True
-
-            old_val = child.value
-            # Update child value
-            try:
-                tree = self.parser.parse(child.contents)
-                evaluator = eval_exp(wb = self, curr_sheet = sheet)
-                final_eval = evaluator.transform(tree)
-                child.value = final_eval.children[0]
-                # If the value is a cell_range object (list of lists), it is TYPE_ERR0R
-                if type(child.value) == list:
-                    child.value = CellError(CellErrorType.TYPE_ERROR, detail =
-                    "function received cell range")
-            except lark.exceptions.LarkError:
-                child.value = CellError(CellErrorType.PARSE_ERROR,
-                    detail = "Can not parse {}".format(contents))
-
-
-            if bool(set(child.parents) & set(child.children)):
-                child.value = CellError(CellErrorType.CIRCULAR_REFERENCE,
-                    detail = "Circ. ref detected")
-
-            # Add updated child
-            self.update_dict[sheet.lower(), cell.lower()].append(child.value)
-
-            # If we run into a cell that has always been a circular reference,
-            # don't append children. Otherwise, we need to keep updating its
-            # children to allow the circular ref error to propagate
-            if isinstance(child.value, CellError):
-                if child.value.get_type() == \
-                            CellErrorType.CIRCULAR_REFERENCE and was_error:
+        stack = [(root, cell)]
+        while stack:
+            key, cell = stack.pop()
+            for child in self._children(key, cell):
+                if child in self.dirty:
                     continue
-
-            if child.value == old_val:
+                child_cell = self._live_cell(child)
+                if child_cell is None:
+                    continue
+                self.dirty[child] = False
+                if child not in self.update_dict:
+                    self.update_dict[child] = [child_cell.value]
+                stack.append((child, child_cell))
+
+    def _dirty_parents(self, key, cell):
+        '''Returns the out of date cells read by a cell, once each'''
+        parents = [parent for parent in cell.parents if parent in self.dirty]
+        ranges = self.range_index.ranges.get(key)
+        if not ranges:
+            return parents
+        for sheet_name, (left, top), (right, bottom) in ranges:
+            sheet = self.sheets.get(sheet_name)
+            if sheet is None:
                 continue
-
-            queue += self.sheets[curr_cell[0]].cells[curr_cell[1]].children
-            queue = list(dict.fromkeys(queue))
-
-        if bulk_op == False:
-            self._process_update_dict()
+            for _, _, location in sheet.cells.cells_in(range(top, bottom + 1),
+                    range(left, right + 1)):
+                if (sheet_name, location) in self.dirty:
+                    parents.append((sheet_name, location))
+        return list(dict.fromkeys(parents))
+
+    def _settle(self, keys):
+        ''' Computes the values of the out of date cells among keys and of
+            the out of date cells they read (lazy workbooks and batches). Up
+            to date cells only read up to date cells, so the search for the
+            cells to evaluate stops at them. The out of date parents of a
+            cell are evaluated before it, depth first; if a cell turns out
+            to read itself, _settle_cycles takes over.'''
+        expanded = {} # cells whose parents were pushed, and their Cell
+        for start in keys:
+            stack = [start]
+            while stack:
+                key = stack[-1]
+                if key not in self.dirty:
+                    stack.pop()
+                    continue
+                cell = expanded.get(key)
+                if cell is not None:
+                    # The parents are up to date
+                    stack.pop()
+                    self._settle_cell(key, cell)
+                    continue
+                cell = self._live_cell(key)
+                if cell is None:
+                    del self.dirty[key]
+                    stack.pop()
+                    continue
+                expanded[key] = cell
+                dirty_parents = self._dirty_parents(key, cell)
+                # The expanded cells that are still out of date are the ones
+                # on the path to this cell
+                if any(parent in expanded for parent in dirty_parents):
+                    self._settle_cycles(keys)
+                    return
+                stack.extend(dirty_parents)
+
+    def _settle_cycles(self, keys):
+        ''' Computes the values of the out of date cells among keys and of
+            the out of date cells they read, when they have cycles. The
+            cells are evaluated in topological order like in _recalculate;
+            every cell of a cycle is a circular reference.'''
+        cells = {}
+        in_degree = {} # number of out of date parents of each cell
+        stack = [key for key in keys if key in self.dirty]
+        while stack:
+            key = stack.pop()
+            if key in cells:
+                continue
+            cell = self._live_cell(key)
+            if cell is None:
+                del self.dirty[key]
+                continue
+            cells[key] = cell
+            dirty_parents = self._dirty_parents(key, cell)
+            in_degree[key] = len(dirty_parents)
+            stack.extend(dirty_parents)
+
+        ready = deque(key for key in cells if in_degree[key] == 0)
+        while ready:
+            key = ready.popleft()
+            del in_degree[key]
+            self._settle_cell(key, cells[key])
+            for child in self._children(key, cells[key]):
+                if child in in_degree:
+                    in_degree[child] -= 1
+                    if in_degree[child] == 0:
+                        ready.append(child)
+
+        if in_degree:
+            # Cells in or after cycles
+            children = {key: [child for child in self._children(key, cells[key])
+                if child in in_degree] for key in in_degree}
+            for key in in_degree:
+                self.dirty.pop(key, None)
+            self._recalculate_cycles(None, in_degree, cells, children, set(in_degree))
+
+    def _settle_cell(self, key, cell):
+        ''' Evaluates an out of date cell whose parents are up to date. A
+            formula that was set while its parents were out of date may
+            have read other cells (through INDIRECT), so its dependencies
+            are recorded again.'''
+        if key not in self.dirty:
+            # Already evaluated for a cell that read it through INDIRECT
+            return
+        formula_set = self.dirty.pop(key)
+        if not formula_set or not cell.is_formula:
+            self._recalculate_cell(key, cell)
+            return
+
+        if key not in self.update_dict:
+            self.update_dict[key] = [cell.value]
+        old_parents = cell.parents
+        old_val = cell.value
+        evaluator = self._evaluate_formula(cell, key[0])
+        self._value_changed(key, old_val, cell.value)
+        self._update_dependencies(key[0], key[1], cell, evaluator, old_parents)
+        late_parents = self._dirty_parents(key, cell)
+        if late_parents:
+            self._settle(late_parents)
+            old_val = cell.value
+            self._evaluate_formula(cell, key[0])
+            self._value_changed(key, old_val, cell.value)
+        self.update_dict[key].append(cell.value)
 
     def _process_update_dict(self):
+        # Inside a batch, cells are notified once at the end of it
+        if self.batch_depth:
+            return
         # Go though update dictionary and find changed cells
         changed_cells = []
+        pending = {} # out of date cells are notified once they are computed
         for cell_tup in self.update_dict:
             cell_vals = self.update_dict[cell_tup]
+            if cell_tup in self.dirty:
+                pending[cell_tup] = cell_vals
+                continue
+            # Every cell whose value changed is here, so the extents of the
+            # sheets are updated with them
+            if cell_tup[0] in self.sheets:
+                self.sheets[cell_tup[0]].update_extent(cell_tup[1])
 
             # Both are errors, so check type
-            if isinstance(cell_vals[0], CellError) and isinstance(cell_vals[1], CellError):
-                if cell_vals[0].get_type() != cell_vals[1].get_type():
+            if isinstance(cell_vals[0], CellError) and isinstance(cell_vals[-1], CellError):
+                if cell_vals[0].get_type() != cell_vals[-1].get_type():
                     changed_cells.append(cell_tup)
             else:
                 if cell_vals[0] != cell_vals[-1]:
                     changed_cells.append(cell_tup)
 
         # Get actual sheet names and cells
-        changed = [(self.sheets[s].name, cell.upper()) for s, cell in changed_cells]
-        # Call helper function to notify registered cell change functions
-        self._cell_notification_helper(changed)
-        self.update_dict = {}
+        changed = [(self.sheets[s].name, cell.upper()) for s, cell in changed_cells
+            if s in self.sheets]
+        # Call helper function to notify registered cell change functions,
+        # unless no cell changed
+        if changed:
+            self._cell_notification_helper(changed)
+        self.update_dict = pending
 
 
     def _cell_notification_helper(self, changed_cells):
@@ -612,10 +1065,11 @@ class Workbook:
             raise KeyError("Sheet {} not in workbook.".format(sheet_name))
         get_cell_tuple(location)
 
-        if location.lower() not in self.sheets[sheet_name].cells:
+        cell = self.sheets[sheet_name].cells.peek(location.lower())
+        if cell is None:
             return None
 
-        return self.sheets[sheet_name].cells[location.lower()].contents
+        return cell.contents
 
     def get_cell_value(self, sheet_name: str, location: str) -> Any:
         '''Return the evaluated value of the specified cell on the specified
@@ -631,14 +1085,88 @@ class Workbook:
         The value of empty cells is None.  Non-empty cells may contain a
         value of str, decimal.Decimal, or CellError.'''
 
+        value = self._stored_value(sheet_name, location)
+        key = (sheet_name.lower(), location.lower())
+        if key in self.dirty:
+            self._settle([key])
+            value = self.sheets[key[0]].cells[key[1]].value
+            self._process_update_dict()
+        return value
+
+    def _stored_value(self, sheet_name, location):
+        ''' Returns the value stored in a cell, without computing it if it
+            is out of date (see get_cell_value)'''
         sheet_name = sheet_name.lower()
         if sheet_name.lower() not in self.sheets:
             raise KeyError("Sheet {} not in workbook.".format(sheet_name))
         get_cell_tuple(location)
 
-        if location.lower() not in self.sheets[sheet_name].cells:
-            return None
-        return self.sheets[sheet_name].cells[location.lower()].value
+        return self.sheets[sheet_name].cells.value(location.lower())
+
+    def get_region_values(self, sheet_name: str, start_location: str,
+            end_location: str, dtype = None) -> Any:
+        '''Return the values of a region of a sheet as a list of rows, each
+        a list of the values of the cells in that row (as get_cell_value).
+
+        The start_location and end_location are two corners of the region;
+        both are included. For example get_region_values("Sheet1", "A1",
+        "B2") returns [[A1, B1], [A2, B2]].
+
+        If dtype is given, a NumPy array of that dtype is returned instead
+        (NumPy must be installed). With dtype=object the array holds the
+        values themselves; with dtype=float, numbers are converted and every
+        other cell (empty, text, booleans, errors) is nan.
+
+        If the specified sheet name is not found, a KeyError is raised.
+        If either cell location is invalid, a ValueError is raised.'''
+        cell_range = self._region(sheet_name, start_location, end_location)
+        if self.dirty:
+            # Compute the out of date cells of the region first
+            key = sheet_name.lower()
+            dirty = [(key, location) for _, _, location in
+                cell_range.cells.cells_in(cell_range.rows, cell_range.cols)
+                if (key, location) in self.dirty]
+            if dirty:
+                self._settle(dirty)
+                self._process_update_dict()
+
+        grid = cell_range.grid()
+        if dtype is None:
+            return grid
+        import numpy
+        if dtype in (float, numpy.float64, "float", "float64"):
+            nan = float("nan")
+            grid = [[float(value) if isinstance(value, decimal.Decimal) else nan
+                for value in row] for row in grid]
+        return numpy.array(grid, dtype = dtype)
+
+    def get_region_contents(self, sheet_name: str, start_location: str,
+            end_location: str, dtype = None) -> Any:
+        '''Return the contents of a region of a sheet as a list of rows, the
+        same way get_region_values returns the values. Empty cells are None.
+
+        If dtype is given (normally object), a NumPy array of that dtype is
+        returned instead.
+
+        If the specified sheet name is not found, a KeyError is raised.
+        If either cell location is invalid, a ValueError is raised.'''
+        grid = self._region(sheet_name, start_location, end_location) \
+            .grid("contents")
+        if dtype is None:
+            return grid
+        import numpy
+        return numpy.array(grid, dtype = dtype)
+
+    def _region(self, sheet_name, start_location, end_location):
+        ''' Checks a sheet name and the two corners of a region, and returns
+            the CellRange of the region'''
+        if sheet_name.lower() not in self.sheets:
+            raise KeyError("Sheet {} not in workbook.".format(sheet_name))
+        c1 = get_cell_tuple(start_location)
+        c2 = get_cell_tuple(end_location)
+        rows = range(min(c1[1], c2[1]), max(c1[1], c2[1]) + 1)
+        cols = range(min(c1[0], c2[0]), max(c1[0], c2[0]) + 1)
+        return CellRange(self.sheets[sheet_name.lower()].cells, rows, cols)
 
 
     @staticmethod
@@ -664,6 +1192,14 @@ class Workbook:
 
         # create workbook to fill and return
         wb = Workbook()
+        with wb.batch():
+            Workbook._load_sheets(wb, fp)
+        return wb
+
+    @staticmethod
+    def _load_sheets(wb, fp):
+        ''' Loads the sheets of a JSON workbook file into wb, see
+            load_workbook'''
 
         # load in file contents or reports errors
         js = json.load(fp)
@@ -728,8 +1264,6 @@ class Workbook:
                 # all good, so add contents
                 wb.set_cell_contents(name, location, sheet['cell-contents'][location])
 
-        return wb
-
 
     def save_workbook(self, fp: TextIO) -> None:
         '''Instance method (not a static/class method) to save a workbook to a
@@ -796,16 +1330,18 @@ class Workbook:
         # add function to list to be called in modifying functions
         self.notify_functions.append(notify_function)
 
-    def _get_formula_shift_cells(self, contents, shift):
+    def _get_formula_shift_cells(self, contents, shift, tree = None):
         ''' Transforms formula contents to shift cell refrences, then
-            return shifted formula.'''
+            return shifted formula. Uses the cached parse tree of the cell
+            if it is given.'''
 
-        try:
-            tree = self.parser.parse(contents)
-        except lark.exceptions.LarkError:
+        if tree is None:
+            tree = self._parse_formula(contents)
+        if tree is None:
             # Don't touch unparseable formulas --> will be PARSE_ERROR
             return contents
         # Update formula
+        from .formula_transformer import transform_exp
         evaluator = transform_exp(shift = shift)
         final_eval = evaluator.transform(tree)
 
@@ -820,7 +1356,9 @@ class Workbook:
     def _shift_cells_helper(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None):
         ''' Helper function that does steps 1-4 described in move_cells
-            copy_cells.  '''
+            copy_cells. Returns the (location, (col, row)) of the source
+            cells outside of the target area, and the (location, contents,
+            (col, row)) to set in the target area.'''
 
         if sheet_name.lower() not in self.sheets:
             raise KeyError("Sheet {} not in workbook.".format(sheet_name))
@@ -839,44 +1377,52 @@ class Workbook:
         #   - Children/parents taken care of by set_cell_contents()
         # 6. Go through shifted cells an set_cell_contents() to contents we calculated
         #  - Takes care of parents/children
-
+        # Only the cells that exist are looked at: empty cells of the source
+        # area just empty the cells they are shifted to.
 
         c1 = get_cell_tuple(start_location)
         c2 = get_cell_tuple(end_location)
         target = get_cell_tuple(to_location)
 
-        top_left = (min(c1[0], c2[0]), min(c1[1], c2[1]))
-        bottom_right = (max(c1[0], c2[0]), max(c1[1], c2[1]))
-
-        source_tuples = []
-        for col in range(top_left[0], bottom_right[0] + 1):
-            for row in range(top_left[1], bottom_right[1] + 1):
-                source_tuples.append((col, row))
+        left, right = min(c1[0], c2[0]), max(c1[0], c2[0])
+        top, bottom = min(c1[1], c2[1]), max(c1[1], c2[1])
 
-        source_cells = [get_cell_name(tup) for tup in source_tuples]
-
-        # Calculate the cells to move to (shifted cells)
-        col_shift = target[0]-top_left[0]
-        row_shift = target[1]-top_left[1]
+        # Calculate the shift
+        col_shift = target[0] - left
+        row_shift = target[1] - top
         shift = (col_shift, row_shift)
-        shifted_tuples = [(tup[0]+shift[0], tup[1]+shift[1]) for tup in source_tuples]
-        shifted_cells = [get_cell_name(tup) for tup in shifted_tuples]
 
         ### Check for out of bounds errors in target cells
-        try:
-            [get_cell_tuple(tup) for tup in shifted_cells]
-        except ValueError:
+        if right + col_shift > 475254 or bottom + row_shift > 9999:
             raise ValueError("Target cells out of bounds.")
 
         # Go though cells and get new contents (step 4)
-        shifted_contents = []
-        for cell in source_cells:
-            cont = self.get_cell_contents(sheet_name, cell)
-            if cont is not None and cont[0] == "=":
-                cont = self._get_formula_shift_cells(cont, shift)
-            shifted_contents.append(cont)
+        cells = self.sheets[sheet_name.lower()].cells
+        shifted = {} # {shifted (col, row) : new contents}
+        outside = [] # source cells outside of the target area
+        for row, col, location in cells.locations_in(range(top, bottom + 1),
+                range(left, right + 1)):
+            if not (target[0] <= col <= right + col_shift
+                    and target[1] <= row <= bottom + row_shift):
+                outside.append((location, (col, row)))
+            cell = cells.peek(location)
+            cont = cell.contents
+            if cont is None:
+                continue
+            if cont[0] == "=":
+                cont = self._get_formula_shift_cells(cont, shift, tree = cell.tree)
+            shifted[(col + col_shift, row + row_shift)] = cont
+
+        # Cells of the target area with nothing shifted to them become empty
+        target_cells = self.sheets[to_sheet.lower()].cells
+        shifted_contents = [(location, None, (col, row)) for row, col, location in
+            target_cells.locations_in(range(target[1], bottom + row_shift + 1),
+                range(target[0], right + col_shift + 1))
+            if (col, row) not in shifted]
+        shifted_contents.extend((get_location(*position), cont, position)
+            for position, cont in shifted.items())
 
-        return source_cells, shifted_cells, shifted_contents
+        return outside, shifted_contents
 
 
     def move_cells(self, sheet_name: str, start_location: str,
@@ -918,21 +1464,18 @@ class Workbook:
         spreadsheet (i.e. beyond cell ZZZZ9999), a ValueError is raised, and
         no changes are made to the spreadsheet.'''
 
-        source_cells, shifted_cells, shifted_contents = \
+        source_cells, shifted_contents = \
         self._shift_cells_helper(sheet_name, start_location, \
         end_location, to_location, to_sheet  = to_sheet)
 
         if to_sheet is None:
             to_sheet = sheet_name
 
-        ## Set original sell contents to none
-        for cell in list(set(source_cells) - set(shifted_cells)):
-            self.set_cell_contents(sheet_name, cell, None, bulk_op = True)
-
-        for i, cell in enumerate(shifted_cells):
-            self.set_cell_contents(to_sheet, cell, shifted_contents[i], bulk_op = True)
-
-        self._process_update_dict()
+        ## Set original sell contents to none, then the new contents
+        self._set_cells(
+            [(sheet_name.lower(), cell, None, position) for cell, position in source_cells]
+            + [(to_sheet.lower(), cell, contents, position)
+                for cell, contents, position in shifted_contents])
 
     def copy_cells(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None) -> None:
@@ -973,7 +1516,7 @@ class Workbook:
         spreadsheet (i.e. beyond cell ZZZZ9999), a ValueError is raised, and
         no changes are made to the spreadsheet.'''
 
-        _, shifted_cells, shifted_contents = \
+        _, shifted_contents = \
         self._shift_cells_helper(sheet_name, start_location, end_location, \
          to_location, to_sheet  = to_sheet)
 
@@ -981,10 +1524,8 @@ class Workbook:
             to_sheet = sheet_name
 
         ## Set new contents
-        for i, cell in enumerate(shifted_cells):
-            self.set_cell_contents(to_sheet, cell, shifted_contents[i], bulk_op = True)
-
-        self._process_update_dict()
+        self._set_cells([(to_sheet.lower(), cell, contents, position)
+            for cell, contents, position in shifted_contents])
 
     def sort_region(self, sheet_name: str, start_location: str, end_location: str, sort_cols: List[int]):
         '''Sort the specified region of a spreadsheet with a stable sort, using
@@ -1033,15 +1574,9 @@ class Workbook:
         If the sort_cols list is invalid in any way, a ValueError is raised.'''
 
         # Check validity of sheet name, cell values, and column indices
-        if sheet_name.lower() not in self.sheets:
-            raise KeyError("Sheet {} not in workbook.".format(sheet_name))
-        c1 = get_cell_tuple(start_location)
-        c2 = get_cell_tuple(end_location)
-
-        top_left = (min(c1[0], c2[0]), min(c1[1], c2[1]))
-        bottom_right = (max(c1[0], c2[0]), max(c1[1], c2[1]))
-
-
+        region = self._region(sheet_name, start_location, end_location)
+        top, left = region.rows[0], region.cols[0]
+        bottom_right = (region.cols[-1], region.rows[-1])
 
         # check sort_cols
         for c in sort_cols:
@@ -1054,19 +1589,11 @@ class Workbook:
         if len(abs_cols) != len(set(abs_cols)):
             raise ValueError("sort_cols contains duplicates")
 
-        source_cells = []
-        for row in range(top_left[1], bottom_right[1] + 1):
-            row_tup = []
-            for col in range(top_left[0], bottom_right[0] + 1):
-                row_tup.append(get_cell_name((col, row)))
-            source_cells.append(row_tup)
-
-        # Get original column and value grids
-        c_grid = [[self.get_cell_contents(sheet_name, cell) for cell in row] \
-                                                     for row in source_cells]
-
-        v_grid = [[self.get_cell_value(sheet_name, cell) for cell in row] \
-                                                     for row in source_cells ]
+        # Get original column and value grids, and the cached parse trees of
+        # the formulas in the region
+        c_grid = region.grid("contents")
+        t_grid = region.grid("tree")
+        v_grid = self.get_region_values(sheet_name, start_location, end_location)
 
         # Generate row objects and sort them
         row_objects = []
@@ -1075,7 +1602,9 @@ class Workbook:
 
         sorted_rows = sorted(row_objects)
 
-        # Move rows
+        # Move rows, recalculating once at the end
+        sheet_key = sheet_name.lower()
+        new_cells = []
         for row_ind, row_obj in enumerate(sorted_rows):
             old_ind = row_obj.row_ind
             row_shift = row_ind - old_ind
@@ -1086,20 +1615,20 @@ class Workbook:
             # Generate the row's new contents
             old_contents = c_grid[old_ind]
             new_contents = []
-            for cont in old_contents:
+            for col_ind, cont in enumerate(old_contents):
                 if cont is not None and cont[0] == "=":
-                    cont = self._get_formula_shift_cells(cont, (0,row_shift))
+                    cont = self._get_formula_shift_cells(cont, (0,row_shift),
+                        tree = t_grid[old_ind][col_ind])
                 new_contents.append(cont)
 
             # Go though and set new contents
-            row_cells = source_cells[row_ind]
-            for col_ind, cell in enumerate(row_cells):
+            for col_ind, cont in enumerate(new_contents):
                 # Only set contents if new contents is different from what was
                 # previously in this location
-                if new_contents[col_ind] != c_grid[row_ind][col_ind]:
-                    self.set_cell_contents(sheet_name, cell, new_contents[col_ind], bulk_op = True)
-
-        self._process_update_dict()
+                if cont != c_grid[row_ind][col_ind]:
+                    position = (left + col_ind, top + row_ind)
+                    new_cells.append((sheet_key, get_location(*position), cont, position))
+        self._set_cells(new_cells)
 
         ## Process:
         # 1. Generate get grids of values and contents
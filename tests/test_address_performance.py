@@ -0,0 +1,31 @@
+'''Per-call cost of the cell location conversions'''
+import context
+import timeit
+import random
+from sheets.cell_address import get_cell_tuple, get_cell_name, column_name, \
+    column_number, split_location
+
+if __name__ == '__main__':
+
+    rnd = random.Random(0)
+    tuples = [(rnd.randint(1, 475254), rnd.randint(1, 9999)) for i in range(10000)]
+    names = [get_cell_name(tup) for tup in tuples]
+    hot = names[:100] # the same few cells over and over, like a sheet recalculating
+
+    def per_call(function, args):
+        '''Best per-call time in nanoseconds over a few runs'''
+        runs = timeit.repeat(lambda: [function(arg) for arg in args],
+            number = 10, repeat = 5)
+        return min(runs) / (10 * len(args)) * 1e9
+
+    get_cell_tuple.cache_clear()
+    print("get_cell_tuple (cold)  {:7.0f} ns".format(
+        timeit.timeit(lambda: [get_cell_tuple.__wrapped__(name) for name in names],
+            number = 5) / (5 * len(names)) * 1e9))
+    print("get_cell_tuple (hot)   {:7.0f} ns".format(per_call(get_cell_tuple, hot)))
+    print("split_location         {:7.0f} ns".format(per_call(split_location, names)))
+    print("get_cell_name          {:7.0f} ns".format(per_call(get_cell_name, tuples)))
+    print("column_name            {:7.0f} ns".format(
+        per_call(column_name, [tup[0] for tup in tuples])))
+    print("column_number          {:7.0f} ns".format(
+        per_call(column_number, [name.rstrip("0123456789") for name in names])))
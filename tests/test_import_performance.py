@@ -0,0 +1,38 @@
+'''Times importing the package in a fresh interpreter, for value-only
+workbooks and for workbooks that set a formula'''
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SCRIPTS = {
+    "import sheets": "import sheets",
+    "values only": "import sheets\n"
+        "wb = sheets.Workbook()\n"
+        "wb.new_sheet('S')\n"
+        "wb.set_cell_contents('S', 'A1', '5')\n",
+    "one formula": "import sheets\n"
+        "wb = sheets.Workbook()\n"
+        "wb.new_sheet('S')\n"
+        "wb.set_cell_contents('S', 'A1', '=1 + 2')\n",
+}
+
+def time_script(script, runs):
+    '''Median wall time of running script in a new interpreter'''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", script], cwd = ROOT, check = True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+
+    baseline = time_script("pass", 10)
+    print("{:<15} {:.1f} ms".format("python", baseline * 1000))
+    for name, script in SCRIPTS.items():
+        # Cost on top of starting the interpreter
+        print("{:<15} {:.1f} ms".format(name, (time_script(script, 10) - baseline) * 1000))
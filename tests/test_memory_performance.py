@@ -0,0 +1,51 @@
+'''Memory used per cell, for number, constant and formula sheets'''
+import context
+import gc
+import tracemalloc
+from sheets import Workbook
+from sheets.cell_address import get_cell_tuple
+
+ROWS = 2000
+COLS = 10
+
+def bytes_per_cell(cell_contents):
+    '''Bytes allocated per cell by a workbook with one sheet of cells'''
+    # Imports and caches shared by all workbooks are not counted
+    warm_up = Workbook()
+    warm_up.new_sheet("S")
+    warm_up.set_cells_contents("S", dict(list(cell_contents.items())[:100]))
+    del warm_up
+    gc.collect()
+    tracemalloc.start()
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", cell_contents)
+    get_cell_tuple.cache_clear()
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / len(cell_contents)
+
+if __name__ == '__main__':
+
+    columns = "ABCDEFGHIJ"[:COLS]
+
+    # Numbers only
+    numbers = {"{}{}".format(col, row): str(row * i + 0.5)
+        for row in range(1, ROWS + 1) for i, col in enumerate(columns)}
+    print("numbers         {:6.0f} bytes/cell".format(bytes_per_cell(numbers)))
+
+    # Numbers and text
+    constants = {"{}{}".format(col, row): str(row * i) if i % 2 else "text" + str(row)
+        for row in range(1, ROWS + 1) for i, col in enumerate(columns)}
+    print("constants       {:6.0f} bytes/cell".format(bytes_per_cell(constants)))
+
+    # A column of numbers and formulas filled across from it
+    formulas = {"{}{}".format(col, row): "=A{} * {} + {}{}".format(row, i, columns[i - 1],
+        row) if i else str(row) for row in range(1, ROWS + 1) for i, col in enumerate(columns)}
+    print("formulas        {:6.0f} bytes/cell".format(bytes_per_cell(formulas)))
+
+    # Formulas that each read a range of numbers
+    ranges = {"{}{}".format(col, row): "=SUM(A{}:A{})".format(max(1, row - 5), row)
+        if i else str(row) for row in range(1, ROWS + 1) for i, col in enumerate(columns)}
+    print("range formulas  {:6.0f} bytes/cell".format(bytes_per_cell(ranges)))
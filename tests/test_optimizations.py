@@ -0,0 +1,1109 @@
+'''Tests for the performance optimizations of the engine'''
+import context
+
+# Now we can import other things
+import decimal
+import pytest
+from sheets import Workbook, CellError, CellErrorType
+import sheets
+# pylint: disable=protected-access
+
+def is_error(val, error_type):
+    '''checks if error'''
+    if isinstance(val, CellError):
+        if val.get_type() == error_type:
+            return True
+    return False
+
+
+def test_formula_tree_cached():
+    '''Formulas are parsed once and the tree is reused on recalculation'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "1")
+    book.set_cell_contents("S", "A2", "=A1 + 1")
+    tree = book.sheets["s"].cells["a2"].tree
+    assert tree is not None
+
+    book.set_cell_contents("S", "A1", "5")
+    assert book.get_cell_value("S", "A2") == 6
+    assert book.sheets["s"].cells["a2"].tree is tree
+
+    # Unparseable formulas have no tree
+    book.set_cell_contents("S", "A3", "=A1 +")
+    assert book.sheets["s"].cells["a3"].tree is None
+    assert is_error(book.get_cell_value("S", "A3"), CellErrorType.PARSE_ERROR)
+
+
+PARITY_FORMULAS = [
+    '=1', '=1.50', '=-0', '=+"5"', '=-"abc"', '=-A1', '=A1', '=Z9', '=S2!A1',
+    "='S2'!B1", '=nonexistent!A1', '=ZZZZZ1', '=A1 + B1 * 2', '=A1 - C1',
+    '=A1 / 0', '=A1 / Z9', '=C1 + 1', '=C1 * 2', '=D1 + 1', '=(A1 + 2) * 3',
+    '=E1 + 1', '=1 / 3', '=A1 & B1', '=C1 & D1 & Z9', '=(1 = 1) & "x"',
+    '=A1 < B1', '=C1 = "HELLO"', '=D1 > 5', '=Z9 = 0', '=E1 = 1', '=A1 <> C1',
+    '=SUM(A1:B2)', '=SUM(A1, B1, 5)', '=SUM(Z1:Z5)', '=SUM(C1)',
+    '=AVERAGE(A1:B1)', '=AVERAGE(Z1:Z3)', '=MIN(A1, Z9)', '=MAX(A1:D1)',
+    '=MIN(C1:D1)', '=SUM(nonexistent!A1:A2)', '=SUM(A1:ZZZZZ1)',
+    '=IF(A1, B1, C1)', '=IF(FALSE, 1, Z9)', '=IFERROR(E1, "bad")',
+    '=IFERROR(A1)', '=CHOOSE(2, A1, B1)', '=CHOOSE(1, A1:B1)',
+    '=CHOOSE(1, A1:B1) + 1', '=ISBLANK(Z9)', '=ISERROR(E1)', '=NOT(A1)',
+    '=AND(A1, B1)', '=OR(FALSE, Z9)', '=XOR(TRUE, FALSE)', '=EXACT(C1, "hello")',
+    '=VERSION()', '=UNKNOWN(A1)', '=sum(1)', '=VLOOKUP(1, A1:B2, 2)',
+    '=HLOOKUP(1, A1:B2, 2)', '=INDIRECT(A1)', '=INDIRECT(Z9)', '=INDIRECT("A1")',
+    '=INDIRECT("Z9")', '=ISBLANK(INDIRECT(Z9))', '=ISBLANK(INDIRECT("Z9"))',
+    '=INDIRECT("S2!A1")', '=INDIRECT("nonexistent!A1")', '=INDIRECT("not a ref")',
+    '=INDIRECT(5)', '=INDIRECT(TRUE)', '=INDIRECT("5")', '=INDIRECT(1 / 0)',
+    '=INDIRECT(A1, B1)', '=INDIRECT()', '=INDIRECT(IF(TRUE, 1 / 0, 1))',
+    '=INDIRECT(SUM("a"))', '=SUM(INDIRECT("A1:B2"))', '=INDIRECT("A1:B2")',
+    '=INDIRECT("""A1""")', '=INDIRECT(F1)', '=INDIRECT("A1) + (B1")',
+    '=INDIRECT(INDIRECT(Z9))', '=A1 + INDIRECT("Z9")',
+]
+
+def _reference_value(book, sheet_name, tree):
+    '''Evaluates a tree with the reference lark evaluator'''
+    import lark
+    from sheets.formula_parser import eval_exp
+    evaluator = eval_exp(wb = book, curr_sheet = sheet_name)
+    try:
+        value = evaluator.transform(tree).children[0]
+    except lark.exceptions.LarkError:
+        return CellError(CellErrorType.PARSE_ERROR, ""), evaluator
+    if type(value) == list:
+        value = CellError(CellErrorType.TYPE_ERROR, "")
+    return value, evaluator
+
+def test_compiled_formula_parity():
+    '''Compiled formulas produce the same values and parents as eval_exp'''
+    from sheets.formula_compiler import EvalContext, compile_formula
+    book = Workbook()
+    book.new_sheet("S")
+    book.new_sheet("S2")
+    book.set_cell_contents("S", "A1", "1")
+    book.set_cell_contents("S", "B1", "2.50")
+    book.set_cell_contents("S", "A2", "3")
+    book.set_cell_contents("S", "B2", "4")
+    book.set_cell_contents("S", "C1", "hello")
+    book.set_cell_contents("S", "D1", "true")
+    book.set_cell_contents("S", "E1", "=1/0")
+    book.set_cell_contents("S", "F1", "'A1")
+    book.set_cell_contents("S2", "A1", "7")
+    book.set_cell_contents("S2", "B1", "=S!A1 * 2")
+
+    for formula in PARITY_FORMULAS:
+        tree = book.parser.parse(formula)
+        expected, evaluator = _reference_value(book, "s", tree)
+        ctx = EvalContext(book, "s")
+        actual = compile_formula(tree).evaluate(ctx)
+
+        if isinstance(expected, CellError):
+            assert is_error(actual, expected.get_type()), formula
+        else:
+            assert type(actual) == type(expected), formula
+            assert str(actual) == str(expected), formula
+        # Ranges are recorded as a whole instead of cell by cell
+        parents, bad_cells = set(ctx.parent_cells), set(ctx.bad_cells)
+        for sheet_name, (left, top), (right, bottom) in ctx.parent_ranges:
+            for col in range(left, right + 1):
+                for row in range(top, bottom + 1):
+                    name = sheets.cell.get_cell_name((col, row)).lower()
+                    if sheet_name in book.sheets:
+                        parents.add((sheet_name, name))
+                    else:
+                        bad_cells.add((sheet_name, name))
+        assert parents == set(evaluator.parent_cells), formula
+        assert bad_cells == set(evaluator.bad_cells), formula
+
+
+def test_filled_down_formulas_share_template():
+    '''Formulas that only differ by a shift share one compiled template'''
+    book = Workbook()
+    book.new_sheet("S")
+    for row in range(1, 21):
+        book.set_cell_contents("S", "A" + str(row), str(row))
+        book.set_cell_contents("S", "B" + str(row), "2")
+        book.set_cell_contents("S", "C" + str(row),
+            "=A{0} * B{0} + $A$1 + SUM($A$1:A{0})".format(row))
+
+    cells = book.sheets["s"].cells
+    template = cells["c1"].formula.template
+    for row in range(1, 21):
+        assert cells["c" + str(row)].formula.template is template
+        expected = row * 2 + 1 + row * (row + 1) // 2
+        assert book.get_cell_value("S", "C" + str(row)) == expected
+
+    # Shifted values follow their own parents
+    book.set_cell_contents("S", "A5", "100")
+    assert book.get_cell_value("S", "C5") == 200 + 1 + 110
+    assert book.get_cell_value("S", "C4") == 8 + 1 + 10
+
+    # Different function names, sheet names or literals are different templates
+    book.set_cell_contents("S", "D1", "=A1 + 1")
+    book.set_cell_contents("S", "D2", "=A2 + 2")
+    assert cells["d1"].formula.template is not cells["d2"].formula.template
+    assert book.get_cell_value("S", "D2") == 4
+
+    # A shifted reference that falls outside the sheet is a bad reference
+    book.set_cell_contents("S", "E1", "=ZZZZ9999")
+    book.set_cell_contents("S", "E2", "=ZZZZ10000")
+    assert cells["e1"].formula.template is cells["e2"].formula.template
+    assert book.get_cell_value("S", "E1") == 0
+    assert is_error(book.get_cell_value("S", "E2"), CellErrorType.BAD_NAME)
+
+    # The tree is parsed on demand for cells that reuse a template
+    assert cells["c7"].tree is not None
+
+
+def test_filled_down_comparisons_share_template():
+    '''A reference before != is not read as a sheet name'''
+    book = Workbook()
+    book.new_sheet("S")
+    for row in (1, 2):
+        book.set_cell_contents("S", "A" + str(row), str(row))
+        book.set_cell_contents("S", "B" + str(row), "1")
+        book.set_cell_contents("S", "C" + str(row), "=A{0}!=B{0}".format(row))
+        book.set_cell_contents("S", "D" + str(row), "=A{0} <> B{0}".format(row))
+
+    cells = book.sheets["s"].cells
+    for col in "cd":
+        assert cells[col + "1"].formula.template is cells[col + "2"].formula.template
+        assert book.get_cell_value("S", col.upper() + "1") is False
+        assert book.get_cell_value("S", col.upper() + "2") is True
+        assert sorted(cells[col + "1"].parents) == [("s", "a1"), ("s", "b1")]
+        assert sorted(cells[col + "2"].parents) == [("s", "a2"), ("s", "b2")]
+
+    book.set_cell_contents("S", "A1", "2")
+    assert book.get_cell_value("S", "C1") is True
+    assert book.get_cell_value("S", "D1") is True
+
+
+# The Earley grammar that formulas.lark replaced; the LALR grammar must build
+# the same trees.
+EARLEY_GRAMMAR = r'''
+%import common.WS
+%ignore WS
+?formula : "=" compare_expr
+?expression : add_expr | concat_expr | function_expr
+?add_expr : (add_expr ADD_OP)? mul_expr
+?mul_expr : (mul_expr MUL_OP)? unary_op
+?unary_op : ADD_OP? base
+?concat_expr : (concat_expr "&")? base
+?compare_expr : (expression BOOL_OP)? expression
+?function_expr : (FUNC_CALL arg_list)
+?base : cell
+      | NUMBER -> number
+      | STRING -> string
+      | BOOL -> bool
+      | "(" expression ")"
+      | "(" compare_expr ")"
+      | function_expr
+?arg_list: "(" (compare_expr | cell_range)* ("," (compare_expr | cell_range))* ")"
+cell_range : (_sheetname "!")? CELLRANGE
+cell : (_sheetname "!")? CELLREF
+_sheetname : NAME | QUOTED_NAME
+ADD_OP: ("+" | "-")
+MUL_OP: ("*" | "/")
+BOOL_OP: ("==" | "<>" | "!=" | ">=" | "<=" | ">" | "<" | "=" )
+FUNC_CALL: /[A-Za-z][_A-Za-z0-9]*/
+CELLREF: /[$]?[A-Za-z]+[$]?[1-9][0-9]*/
+NAME: /[A-Za-z][A-Za-z0-9]*/
+QUOTED_NAME: /\'[^']*\'/
+CELLRANGE: CELLREF ":" CELLREF
+NUMBER: /([0-9]+(\.[0-9]*)?)|(\.[0-9]+)/
+STRING: /\"[^"]*\"/
+BOOL: /[Tt][Rr][Uu][Ee]/ | /[Ff][Aa][Ll][Ss][Ee]/
+'''
+
+GRAMMAR_FORMULAS = PARITY_FORMULAS + [
+    '=A1+B1-C1+D1', '=A1*B1/C1*2', '=1-2-3', '=-A1*-B1', '=+A1 - +B1',
+    '=A1 & "x" & B1', '=(A1 & B1) + 1', '=A1 + B1 = C1 & D1', '=(A1 < B1) = TRUE',
+    '=A1!=B1', '=A1 == B1', '=A1<=B1', '=A1>=B1', "='S2'!A1 + S2!B1",
+    '=S2 ! A1', '=SUM( A1 , B1 )', '=SUM(,A1)', '=SUM(A1:B2, S2!A1:$B$2)',
+    '=IF(TRUE, FALSE, true)', '=iferror(1 / 0, "x")', '=f_1(A1)', '=AB12(1)',
+    '=A1(1)', '=TRUE()', '=TRUEX', '=TRUE1', '=Sheet1!TRUE1', '=$A$1 + A$1 + $A1',
+    '=.5 + 1. + 10.25', '="a b" & "" & "c"', '=((((A1))))', '=A1:B2', '=A1 B1',
+    '=A1 +', '=1 & 2 + 3', '=SUM(A1', '=(A1 = B1) <> (C1 = D1)', "='S 2'!A1:B2",
+    '=INDIRECT("A" & 1)', '=CHOOSE(1, A1:B2, 3) & ""', '=1=2=3',
+]
+
+def test_lalr_grammar_parity():
+    '''The LALR grammar builds the same trees as the Earley grammar did, so
+       formulas keep their values'''
+    import lark
+    earley = lark.Lark(EARLEY_GRAMMAR, start='formula')
+    book = Workbook()
+    book.new_sheet("S")
+    book.new_sheet("S2")
+    book.set_cell_contents("S", "A1", "1")
+    book.set_cell_contents("S", "B1", "2.50")
+    book.set_cell_contents("S", "C1", "hello")
+    book.set_cell_contents("S", "D1", "true")
+    book.set_cell_contents("S2", "A1", "7")
+
+    for i, formula in enumerate(GRAMMAR_FORMULAS):
+        try:
+            expected = earley.parse(formula)
+        except lark.exceptions.LarkError:
+            expected = None
+        try:
+            actual = book.parser.parse(formula)
+        except lark.exceptions.LarkError:
+            actual = None
+        assert actual == expected, formula
+        if expected is None:
+            continue
+        assert [t.type for t in actual.scan_values(lambda v: True)] == \
+            [t.type for t in expected.scan_values(lambda v: True)], formula
+
+        # And the cell evaluates like the Earley tree does
+        location = "Z" + str(i + 10)
+        book.set_cell_contents("S", location, formula)
+        value, _ = _reference_value(book, "s", expected)
+        if isinstance(value, CellError):
+            assert is_error(book.get_cell_value("S", location),
+                value.get_type()), formula
+        else:
+            assert str(book.get_cell_value("S", location)) == str(value), formula
+
+
+def test_parser_cache(tmp_path):
+    '''The built parser is saved and reused until the grammar changes'''
+    from sheets import formula_grammar
+    grammar_path = tmp_path / "formulas.lark"
+    cache_path = tmp_path / "formulas.lark.cache"
+    with open(formula_grammar.GRAMMAR_PATH, encoding = 'utf-8') as f:
+        grammar = f.read()
+    grammar_path.write_text(grammar, encoding = 'utf-8')
+
+    built = formula_grammar.load_parser(str(grammar_path), str(cache_path))
+    assert cache_path.exists()
+    loaded = formula_grammar.load_parser(str(grammar_path), str(cache_path))
+    assert loaded.source_path == '<deserialized>'
+    assert loaded.parse("=SUM(A1:B2) + S!C3") == built.parse("=SUM(A1:B2) + S!C3")
+
+    # A different grammar does not use the stale cache
+    grammar_path.write_text(grammar.replace('"=" compare_expr', '"+" compare_expr'),
+        encoding = 'utf-8')
+    rebuilt = formula_grammar.load_parser(str(grammar_path), str(cache_path))
+    assert rebuilt.source_path != '<deserialized>'
+    assert rebuilt.parse("+1") is not None
+
+    # A damaged cache is rebuilt
+    cache_path.write_bytes(b"not a parser")
+    assert formula_grammar.load_parser(str(grammar_path),
+        str(cache_path)).parse("+1") is not None
+
+    # Every workbook shares the package parser
+    assert Workbook().parser is Workbook().parser is formula_grammar.parser
+
+
+def test_value_only_workbook_does_not_import_lark():
+    '''The formula machinery is only imported once a formula is set'''
+    import os
+    import subprocess
+    import sys
+    script = "\n".join([
+        "import sys",
+        "import sheets",
+        "wb = sheets.Workbook()",
+        "wb.new_sheet('S')",
+        "wb.set_cell_contents('S', 'A1', '5')",
+        "assert wb.get_cell_value('S', 'A1') == 5",
+        "assert 'lark' not in sys.modules, 'lark imported'",
+        "assert 'sheets.formula_compiler' not in sys.modules",
+        "wb.set_cell_contents('S', 'A2', '=A1 * 2')",
+        "assert wb.get_cell_value('S', 'A2') == 10",
+        "assert 'lark' in sys.modules",
+    ])
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    subprocess.run([sys.executable, "-c", script], cwd = root, check = True)
+
+
+def _count_evaluations(book):
+    '''Counts the formulas evaluated by the workbook, per cell'''
+    counts = {}
+    evaluate = book._evaluate_formula
+    def counting(cell, sheet_name):
+        key = (sheet_name, [k for k, v in book.sheets[sheet_name].cells.items()
+            if v is cell][0])
+        counts[key] = counts.get(key, 0) + 1
+        return evaluate(cell, sheet_name)
+    book._evaluate_formula = counting
+    return counts
+
+def test_recalculation_evaluates_each_cell_once():
+    '''Dirty cells are evaluated once, after all of their parents'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "1")
+    # A chain, and cells that depend on both the start and the end of it
+    for row in range(2, 30):
+        book.set_cell_contents("S", "A" + str(row), "=A{} + 1".format(row - 1))
+        book.set_cell_contents("S", "B" + str(row), "=A1 + A29 + B{}".format(row - 1))
+
+    counts = _count_evaluations(book)
+    book.set_cell_contents("S", "A1", "2")
+    assert book.get_cell_value("S", "A29") == 30
+    assert book.get_cell_value("S", "B2") == 32
+    assert book.get_cell_value("S", "B29") == 32 * 28
+    assert set(counts.values()) == {1}
+    assert len(counts) == 28 * 2
+
+    # Cells whose parents did not change are not evaluated
+    book.set_cell_contents("S", "C1", "=IF(A1 > 100, 1, 0)")
+    book.set_cell_contents("S", "C2", "=C1 * 2")
+    counts.clear()
+    book.set_cell_contents("S", "A1", "3")
+    assert ("s", "c1") in counts and ("s", "c2") not in counts
+
+
+def test_recalculation_cycles():
+    '''Cells in cycles below an updated cell are circular references, and
+       cells after them are updated once'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "1")
+    book.set_cell_contents("S", "B1", "=A1 + D1")
+    book.set_cell_contents("S", "C1", "=B1")
+    book.set_cell_contents("S", "D1", "=C1")
+    book.set_cell_contents("S", "E1", "=D1 & A1")
+    for cell in ["B1", "C1", "D1", "E1"]:
+        assert is_error(book.get_cell_value("S", cell),
+            CellErrorType.CIRCULAR_REFERENCE), cell
+
+    changed = []
+    book.notify_cells_changed(lambda wb, cells: changed.extend(cells))
+    book.set_cell_contents("S", "A1", "2")
+    for cell in ["B1", "C1", "D1", "E1"]:
+        assert is_error(book.get_cell_value("S", cell),
+            CellErrorType.CIRCULAR_REFERENCE), cell
+    assert changed == [("S", "A1")]
+
+    # Breaking the cycle updates every cell
+    book.set_cell_contents("S", "D1", "5")
+    assert book.get_cell_value("S", "B1") == 7
+    assert book.get_cell_value("S", "C1") == 7
+    assert book.get_cell_value("S", "E1") == "52"
+
+
+def test_self_reference_updates_dependents():
+    '''Cells that read a cell that refers to itself are updated'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "D1", "=B5")
+    book.set_cell_contents("S", "B5", "=B5 + 1")
+    assert is_error(book.get_cell_value("S", "D1"), CellErrorType.CIRCULAR_REFERENCE)
+
+    # Through a range
+    book.set_cell_contents("S", "D2", "=IFERROR(C2, 5)")
+    book.set_cell_contents("S", "D3", "=MIN(C2:C3)")
+    book.set_cell_contents("S", "C2", "=SUM(C2:C3)")
+    assert book.get_cell_value("S", "D2") == 5
+    assert isinstance(book.get_cell_value("S", "D3"), CellError)
+
+
+def test_cycle_check_only_for_cells_in_cycles():
+    '''Only an edit that puts a cell in a cycle pays for the cycle check'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "1")
+    for row in range(2, 200):
+        book.set_cell_contents("S", "A" + str(row), "=A{} + 1".format(row - 1))
+
+    checks = []
+    reaches_itself = book._reaches_itself
+    book._reaches_itself = lambda *args: checks.append(args[0]) or reaches_itself(*args)
+    book.set_cell_contents("S", "A1", "5")
+    book.set_cell_contents("S", "A1", "=B1")
+    assert book.get_cell_value("S", "A199") == 198
+    assert checks == []
+
+    # Closing the loop makes every cell of it a circular reference
+    book.set_cell_contents("S", "A1", "=A199")
+    assert checks == [("s", "a1")]
+    for row in [1, 2, 100, 199]:
+        assert is_error(book.get_cell_value("S", "A" + str(row)),
+            CellErrorType.CIRCULAR_REFERENCE)
+
+    # And opening it again restores the values
+    book.set_cell_contents("S", "A1", "0")
+    assert book.get_cell_value("S", "A199") == 198
+
+
+def test_dependency_edges_are_ordered_sets():
+    '''Edges are kept once, in the order they were added, and removed in
+       O(1) when a formula stops referencing a cell'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "1")
+    for row in range(1, 101):
+        book.set_cell_contents("S", "B" + str(row), "=$A$1 + $A$1 + " + str(row))
+    a1 = book.sheets["s"].cells["a1"]
+    assert list(a1.children) == [("s", "b" + str(row)) for row in range(1, 101)]
+    assert list(book.sheets["s"].cells["b1"].parents) == [("s", "a1")]
+
+    # Re-setting A1 keeps its children
+    book.set_cell_contents("S", "A1", "2")
+    assert len(book.sheets["s"].cells["a1"].children) == 100
+    assert book.get_cell_value("S", "B100") == 104
+
+    book.set_cell_contents("S", "B50", "7")
+    assert ("s", "b50") not in book.sheets["s"].cells["a1"].children
+    assert len(book.sheets["s"].cells["a1"].children) == 99
+
+
+def test_range_dependencies():
+    '''A range is one dependency of the formula reading it, not an edge and
+       a placeholder cell per cell it covers'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "B1", "=SUM(A1:A5000)")
+    assert len(book.sheets["s"].cells) == 1
+    assert book.range_index.ranges[("s", "b1")] == [("s", (1, 1), (1, 5000))]
+
+    book.set_cell_contents("S", "A2500", "4")
+    book.set_cell_contents("S", "A5000", "=A2500 * 2")
+    assert book.get_cell_value("S", "B1") == 12
+    assert book.sheets["s"].cells["a2500"].children == {("s", "a5000"): None}
+    book.set_cell_contents("S", "A2500", "1")
+    assert book.get_cell_value("S", "B1") == 3
+    # Outside of the range
+    book.set_cell_contents("S", "A5001", "100")
+    book.set_cell_contents("S", "B2", "100")
+    assert book.get_cell_value("S", "B1") == 3
+
+    # Ranges reading their own cell are circular
+    book.set_cell_contents("S", "C1", "=SUM(C1:D2)")
+    assert is_error(book.get_cell_value("S", "C1"), CellErrorType.CIRCULAR_REFERENCE)
+    book.set_cell_contents("S", "C1", "=SUM(A1:A3)")
+    assert book.get_cell_value("S", "C1") == 0
+    assert book.range_index.ranges[("s", "c1")] == [("s", (1, 1), (1, 3))]
+    book.set_cell_contents("S", "C1", "5")
+    assert not book.range_index.has_ranges(("s", "c1"))
+
+
+def test_range_dependencies_across_sheets():
+    '''Ranges of sheets that are created, deleted or renamed later'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "=SUM(T!A1:B2)")
+    assert is_error(book.get_cell_value("S", "A1"), CellErrorType.BAD_NAME)
+
+    book.new_sheet("T")
+    assert book.get_cell_value("S", "A1") == 0
+    book.set_cell_contents("T", "B2", "7")
+    assert book.get_cell_value("S", "A1") == 7
+
+    book.rename_sheet("T", "U")
+    assert book.get_cell_contents("S", "A1") == "=SUM(U!A1:B2)"
+    book.set_cell_contents("U", "A1", "1")
+    assert book.get_cell_value("S", "A1") == 8
+
+    book.del_sheet("U")
+    assert is_error(book.get_cell_value("S", "A1"), CellErrorType.BAD_NAME)
+
+    # Renaming a sheet to a name that was already referenced
+    book.new_sheet("V")
+    book.set_cell_contents("S", "A2", "=SUM(W!A1:A2)")
+    book.set_cell_contents("V", "A2", "3")
+    book.rename_sheet("V", "W")
+    assert book.get_cell_value("S", "A2") == 3
+
+
+SPARSE_FORMULAS = [
+    '=SUM(A1:D4)', '=AVERAGE(A1:D4)', '=MIN(A1:D4)', '=MAX(A1:D4)',
+    '=MIN(A1:D2)', '=MAX(B2:D4)', '=SUM(C1:D4)', '=AVERAGE(B1:B4, 5)',
+    '=MIN(D1:D4)', '=MAX(C3:D3)', '=SUM(A3:D3, A1:A2)', '=AVERAGE(C4:D4)',
+    '=MIN(A4:D4)', '=SUM(A1:F9)', '=AVERAGE(A1:E9)',
+]
+
+def test_sparse_range_aggregates():
+    '''Aggregates read only the cells in the sheet, with the same results'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "5")
+    book.set_cell_contents("S", "C1", "abc")
+    book.set_cell_contents("S", "B2", "false")
+    book.set_cell_contents("S", "D2", "-2")
+    book.set_cell_contents("S", "A3", "1E+2")
+    book.set_cell_contents("S", "C3", "1.50")
+    book.set_cell_contents("S", "B4", "=Z1")
+
+    for formula in SPARSE_FORMULAS:
+        tree = book.parser.parse(formula)
+        expected, _ = _reference_value(book, "s", tree)
+        book.set_cell_contents("S", "H1", formula)
+        actual = book.get_cell_value("S", "H1")
+        if isinstance(expected, CellError):
+            assert is_error(actual, expected.get_type()), formula
+        else:
+            assert type(actual) == type(expected), formula
+            assert str(actual) == str(expected), formula
+
+    # Ranges of millions of cells only cost their populated cells
+    book.new_sheet("Big")
+    book.set_cell_contents("Big", "B7", "2.5")
+    book.set_cell_contents("Big", "ZZZZ9999", "-1")
+    book.set_cell_contents("S", "H1", "=SUM(Big!A1:ZZZZ9999) + MIN(Big!A1:ZZZZ9999)")
+    assert book.get_cell_value("S", "H1") == decimal.Decimal("0.5")
+
+
+def test_lazy_workbook():
+    '''A lazy workbook computes values when they are read'''
+    book = Workbook(lazy = True)
+    book.new_sheet("S")
+    changed = []
+    book.notify_cells_changed(lambda wb, cells: changed.extend(cells))
+    book.set_cell_contents("S", "A1", "1")
+    for row in range(2, 30):
+        book.set_cell_contents("S", "A" + str(row), "=A{} + 1".format(row - 1))
+        book.set_cell_contents("S", "B" + str(row), "=SUM(A1:A{})".format(row))
+
+    # Writes do not evaluate the descendants
+    counts = _count_evaluations(book)
+    changed.clear()
+    for value in range(2, 12):
+        book.set_cell_contents("S", "A1", str(value))
+    assert not counts
+    assert ("S", "A29") not in changed
+
+    # Reading a cell evaluates it and the out of date cells it reads, once
+    assert book.get_cell_value("S", "A29") == 39
+    assert set(counts.values()) == {1}
+    assert len(counts) == 28
+    assert ("S", "A29") in changed
+    assert book.get_cell_value("S", "B3") == 11 + 12 + 13
+    assert len(counts) == 29
+    assert book.get_sheet_extent("S") == (2, 29)
+    assert book.get_cell_value("S", "B29") == sum(range(11, 39 + 1))
+    assert set(counts.values()) == {1}
+
+    # Cycles are found when they are read
+    book.set_cell_contents("S", "C1", "=C2 + A1")
+    book.set_cell_contents("S", "C2", "=C1")
+    book.set_cell_contents("S", "C3", "=C2 & \"\"")
+    assert is_error(book.get_cell_value("S", "C3"), CellErrorType.CIRCULAR_REFERENCE)
+    assert is_error(book.get_cell_value("S", "C1"), CellErrorType.CIRCULAR_REFERENCE)
+    book.set_cell_contents("S", "C2", "=A1")
+    assert book.get_cell_value("S", "C1") == 22
+    assert book.get_cell_value("S", "C3") == "11"
+
+    # Formulas set while their parents are out of date read the computed values
+    book.set_cell_contents("S", "A1", "0")
+    book.set_cell_contents("S", "D1", '=INDIRECT("A" & A2)')
+    assert book.get_cell_value("S", "D1") == 0
+
+
+def test_batch():
+    '''Writes in a batch are recalculated and notified once at the end'''
+    book = Workbook()
+    book.new_sheet("S")
+    notifications = []
+    book.notify_cells_changed(lambda wb, cells: notifications.append(sorted(cells)))
+    counts = _count_evaluations(book)
+
+    with book.batch():
+        # Formulas may be set before the cells they read
+        for row in range(2, 30):
+            book.set_cell_contents("S", "A" + str(row), "=A{} + 1".format(row - 1))
+        with book.batch():
+            book.set_cell_contents("S", "A1", "1")
+            book.set_cell_contents("S", "B1", "=SUM(A1:A29)")
+        book.set_cell_contents("S", "C1", "=C2")
+        book.set_cell_contents("S", "C2", "=C1")
+        assert not notifications
+        counts.clear()
+
+    assert len(notifications) == 1
+    assert ("S", "A29") in notifications[0] and ("S", "C2") in notifications[0]
+    assert set(counts.values()) == {1}
+    assert book.get_cell_value("S", "A29") == 29
+    assert book.get_cell_value("S", "B1") == 29 * 30 // 2
+    assert is_error(book.get_cell_value("S", "C1"), CellErrorType.CIRCULAR_REFERENCE)
+
+    # Reading a value inside a batch computes it
+    with book.batch():
+        book.set_cell_contents("S", "A1", "2")
+        assert book.get_cell_value("S", "A3") == 4
+        assert not notifications[1:]
+    assert len(notifications) == 2
+    assert book.get_cell_value("S", "B1") == 29 * 30 // 2 + 29
+
+    # Bulk operations notify once
+    counts.clear()
+    book.copy_cells("S", "A1", "A29", "D1")
+    book.move_cells("S", "D1", "D29", "E1")
+    assert len(notifications) == 4
+    assert book.get_cell_value("S", "E29") == 30
+    assert max(counts.values()) == 1
+
+
+def test_extent_does_not_notify():
+    '''Reading an extent only notifies cells that changed'''
+    book = Workbook()
+    book.new_sheet("S")
+    notifications = []
+    book.notify_cells_changed(lambda wb, cells: notifications.append(list(cells)))
+    book.set_cell_contents("S", "B3", "1")
+    book.set_cell_contents("S", "B3", "1")
+    assert notifications == [[("S", "B3")]]
+    assert book.get_sheet_extent("S") == (2, 3)
+    assert len(notifications) == 1
+
+    # Out of date cells are notified once they are computed
+    with book.batch():
+        book.set_cell_contents("S", "A1", "=B3 + 1")
+        assert book.get_sheet_extent("S") == (2, 3)
+        assert len(notifications) == 1
+    assert notifications[1:] == [[("S", "A1")]]
+    assert book.get_sheet_extent("S") == (2, 3)
+    assert len(notifications) == 2
+
+
+def test_set_cells_contents():
+    '''Bulk writes give the same values as single writes, notified once'''
+    cells = {"A" + str(row): "=A{} * 2".format(row - 1) for row in range(2, 40)}
+    cells.update({"A1": "1", "B1": "=SUM(A1:A39)", "C1": "=Other!A1"})
+
+    single = Workbook()
+    single.new_sheet("S")
+    for location, contents in cells.items():
+        single.set_cell_contents("S", location, contents)
+
+    book = Workbook()
+    book.new_sheet("S")
+    notifications = []
+    book.notify_cells_changed(lambda wb, changed: notifications.append(changed))
+    book.set_cells_contents("s", cells)
+    assert len(notifications) == 1
+    for location in cells:
+        expected = single.get_cell_value("S", location)
+        if isinstance(expected, CellError):
+            assert is_error(book.get_cell_value("S", location), expected.get_type())
+        else:
+            assert book.get_cell_value("S", location) == expected
+    assert book.get_cell_value("S", "A39") == 2 ** 38
+
+    # Cells of several sheets, in order
+    book.new_sheet("Other")
+    assert notifications[-1] == [("S", "C1")]
+    book.set_cells_contents([("S", "A1", "2"), ("other", "A1", "5"),
+        ("S", "D1", "=A1 + C1"), ("S", "D1", "=A1 + C1 + 1"), ("S", "E1", None)])
+    assert len(notifications) == 3
+    assert book.get_cell_value("S", "B1") == 2 ** 40 - 2
+    assert book.get_cell_value("S", "D1") == 8
+    assert book.get_cell_contents("S", "E1") is None
+
+    # Nothing is changed if any sheet or location is bad
+    with pytest.raises(KeyError):
+        book.set_cells_contents([("S", "A1", "3"), ("Missing", "A1", "3")])
+    with pytest.raises(ValueError):
+        book.set_cells_contents("S", {"A1": "3", "A10000": "3"})
+    assert book.get_cell_contents("S", "A1") == "2"
+    assert len(notifications) == 3
+
+
+def test_region_values():
+    '''Regions are read as lists of rows, whichever corners are given'''
+    book = Workbook(lazy = True)
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A1": "1", "B1": "=A1 * 2", "C2": "hi",
+        "A3": "=1/0", "B3": "=C2"})
+    expected = [[1, 2, None], [None, None, "hi"]]
+    assert book.get_region_values("s", "A1", "C2") == expected
+    assert book.get_region_values("S", "c1", "A2") == expected
+    assert book.get_region_contents("S", "C2", "A1") == \
+        [["1", "=A1 * 2", None], [None, None, "hi"]]
+    assert book.get_region_values("S", "D5", "D5") == [[None]]
+
+    # Out of date cells are computed when read
+    book.set_cell_contents("S", "A1", "5")
+    assert book.get_region_values("S", "A1", "B1") == [[5, 10]]
+
+    errors = book.get_region_values("S", "A3", "B3")
+    assert is_error(errors[0][0], CellErrorType.DIVIDE_BY_ZERO)
+    assert errors[0][1] == "hi"
+
+    with pytest.raises(KeyError):
+        book.get_region_values("Missing", "A1", "B2")
+    with pytest.raises(ValueError):
+        book.get_region_contents("S", "A1", "A10000")
+
+
+def test_region_values_numpy():
+    '''Regions can be read as NumPy arrays'''
+    numpy = pytest.importorskip("numpy")
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A1": "1.5", "B1": "x", "A2": "=1/0"})
+    values = book.get_region_values("S", "A1", "B2", dtype = float)
+    assert values.shape == (2, 2) and values[0][0] == 1.5
+    assert numpy.isnan(values[1]).all() and numpy.isnan(values[0][1])
+    values = book.get_region_values("S", "A1", "B2", dtype = object)
+    assert values[0][0] == decimal.Decimal("1.5") and values[0][1] == "x"
+    contents = book.get_region_contents("S", "A1", "B2", dtype = object)
+    assert contents[1][0] == "=1/0" and contents[1][1] is None
+
+
+def test_shift_only_visits_cells_that_exist():
+    '''Moving or copying a huge area only costs as much as its cells'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A1": "1", "B2": "=A1 + 1", "C9999": "x",
+        "D1": "=SUM(A1:B2)"})
+    book.move_cells("S", "A1", "ZZZ9999", "B1")
+    assert book.get_cell_contents("S", "A1") is None
+    assert book.get_cell_contents("S", "C2") == "=B1 + 1"
+    assert book.get_cell_value("S", "E1") == 3
+    assert book.get_sheet_extent("S") == (5, 9999)
+
+    # Empty cells of the source area empty the cells they are copied to
+    book.copy_cells("S", "A1", "ZZZ9999", "A1", "S")
+    book.copy_cells("S", "A1", "B9999", "C1")
+    assert book.get_cell_contents("S", "D9999") is None
+    assert book.get_cell_contents("S", "C2") is None
+    assert book.get_cell_contents("S", "D1") == "1"
+    assert book.get_cell_value("S", "E1") == 1
+    with pytest.raises(ValueError):
+        book.copy_cells("S", "A1", "ZZZZ2", "B1")
+
+
+def test_error_to_value_notified_in_batch():
+    '''A cell that goes from an error to a value in a batch is notified'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cell_contents("S", "A1", "=1/0")
+    notifications = []
+    book.notify_cells_changed(lambda wb, cells: notifications.append(list(cells)))
+    with book.batch():
+        book.set_cell_contents("S", "A1", "=1/0 + 1")
+        book.set_cell_contents("S", "A1", None)
+    assert notifications == [[("S", "A1")]]
+
+
+def test_incremental_extent():
+    '''The extent follows the cells that have a value'''
+    book = Workbook()
+    book.new_sheet("S")
+    assert book.get_sheet_extent("S") == (0, 0)
+    book.set_cell_contents("S", "C2", "1")
+    book.set_cell_contents("S", "E5", "=C2")
+    # An empty cell that is read does not count, nor a formula that is empty
+    book.set_cell_contents("S", "A10", "=Z99")
+    book.set_cell_contents("S", "Q1", "=CHOOSE(1, Z20)")
+    assert book.get_sheet_extent("S") == (5, 10)
+
+    book.set_cell_contents("S", "A10", None)
+    assert book.get_sheet_extent("S") == (5, 5)
+    book.set_cell_contents("S", "E5", None)
+    assert book.get_sheet_extent("S") == (3, 2)
+    book.set_cell_contents("S", "Z20", "x")
+    assert book.get_sheet_extent("S") == (26, 20)
+
+    # Cells computed later, and cells set in a batch
+    book.set_cell_contents("S", "Z20", None)
+    with book.batch():
+        book.set_cell_contents("S", "C2", None)
+        book.set_cell_contents("S", "B3", "=1")
+        assert book.get_sheet_extent("S") == (2, 3)
+    lazy = Workbook(lazy = True)
+    lazy.new_sheet("S")
+    lazy.set_cell_contents("S", "D4", "=CHOOSE(1, A1)")
+    assert lazy.get_sheet_extent("S") == (0, 0)
+    lazy.set_cell_contents("S", "A1", "1")
+    assert lazy.get_sheet_extent("S") == (4, 4)
+
+
+def test_compact_cells():
+    '''Cells have no __dict__, and dependency sets only when they have edges'''
+    from sheets.cell import Cell, FormulaCell, NO_CELLS
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A1": "1", "B1": "text", "C1": "=A1 + 1",
+        "D1": "=1 + 2"})
+    cells = book.sheets["s"].cells
+    assert not hasattr(cells["a1"], "__dict__")
+    assert type(cells["b1"]) is Cell and type(cells["c1"]) is FormulaCell
+    assert cells["b1"].children is NO_CELLS and cells["b1"].parents is NO_CELLS
+    assert cells["d1"].parents is NO_CELLS and cells["d1"].tree is not None
+    assert cells["b1"].tree is None and not cells["b1"].is_formula
+    assert list(cells["a1"].children) == [("s", "c1")]
+
+    # The shared empty sets are never changed
+    book.set_cell_contents("S", "B2", "=B1")
+    book.set_cell_contents("S", "B2", None)
+    assert not NO_CELLS and cells["b1"].children == {}
+    assert book.get_cell_value("S", "C1") == 2
+
+
+
+def test_region_writes_skip_unchanged_cells():
+    '''Moves and copies set the cells of a region in one batch, and only
+       the cells whose contents change'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A1": "1", "A2": "2", "B1": "=A1 + A2", "B2": "2"})
+    changed = []
+    book.notify_cells_changed(lambda wb, cells: changed.extend(cells))
+    book.copy_cells("S", "A2", "A2", "B2")
+    assert changed == []
+    book.move_cells("S", "A1", "A2", "C1")
+    assert sorted(changed) == [("S", "A1"), ("S", "A2"), ("S", "B1"), ("S", "C1"),
+        ("S", "C2")]
+    assert book.get_cell_value("S", "B1") == 0
+
+    # Clearing a cell that refers to itself
+    book.set_cell_contents("S", "D5", "=D5 + 1")
+    book.set_cell_contents("S", "D5", None)
+    assert book.get_cell_value("S", "D5") is None
+    book.set_cells_contents("S", {"D5": "=D5 + 1"})
+    book.move_cells("S", "D5", "D5", "E5")
+    assert book.get_cell_contents("S", "D5") is None
+
+
+def test_number_columns():
+    '''Number constants are kept in typed arrays and only become cells when
+       needed'''
+    import time
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A%d" % row: str(row) for row in range(1, 301)})
+    book.set_cells_contents("S", {"B1": "1.50", "B2": "'7", "B3": "-2.5",
+        "B4": "text"})
+    cells = book.sheets["s"].cells
+    assert dict.__len__(cells) == 3 and cells.numbers[1].count == 300
+    assert not dict.__contains__(cells, "b3")
+    assert len(cells) == 304 and "a300" in cells and "a301" not in cells
+    assert sorted(cells)[:2] == ["a1", "a10"]
+    assert book.get_cell_contents("S", "A12") == "12"
+    assert book.get_cell_value("S", "B3") == decimal.Decimal("-2.5")
+    assert book.get_cell_value("S", "B1") == decimal.Decimal("1.5")
+    assert book.get_sheet_extent("S") == (2, 300)
+
+    # Reading a value leaves the number stored
+    assert cells.peek("a5").contents == "5" and not dict.__contains__(cells, "a5")
+
+    # A number that a formula refers to is a cell, until the formula is gone
+    book.set_cell_contents("S", "C1", "=A7 * 2 + SUM(A1:A300) + B3")
+    assert book.get_cell_value("S", "C1") == decimal.Decimal("45161.5")
+    assert dict.__contains__(cells, "a7") and not dict.__contains__(cells, "a8")
+    book.set_cell_contents("S", "A7", "8")
+    assert book.get_cell_value("S", "C1") == decimal.Decimal("45164.5")
+    book.set_cell_contents("S", "C1", None)
+    assert not dict.__contains__(cells, "a7")
+    assert book.get_cell_value("S", "A7") == 8
+
+    # Moves, copies and sorts
+    book.move_cells("S", "A1", "A3", "D1")
+    assert book.get_cell_contents("S", "A1") is None
+    assert [book.get_cell_value("S", "D%d" % row) for row in range(1, 4)] == [1, 2, 3]
+    book.copy_cells("S", "D1", "D2", "E5")
+    assert book.get_cell_value("S", "E6") == 2
+    book.sort_region("S", "A4", "A300", [-1])
+    assert book.get_cell_value("S", "A4") == 300
+    assert book.get_cell_value("S", "A300") == 4
+
+    # Clearing
+    book.set_cell_contents("S", "A4", None)
+    assert not cells.numbers[1].has(4) and book.get_cell_value("S", "A4") is None
+
+    # A sparse range over a huge area reads only the cells that exist
+    book.new_sheet("Big")
+    book.set_cells_contents("Big", {"A1": "1", "ZZZZ9999": "2", "M500": "3"})
+    start = time.time()
+    book.set_cell_contents("S", "F1", "=SUM(Big!A1:ZZZZ9999)")
+    assert book.get_cell_value("S", "F1") == 6
+    assert time.time() - start < 1
+
+
+def test_number_columns_kept_by_sheet_operations():
+    '''Renaming and deleting a sheet leave its numbers stored'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A%d" % row: str(row) for row in range(1, 101)})
+    book.set_cells_contents("S", {"B1": "=A1 + S!A2", "B2": "=SUM(S!A1:A100)"})
+    book.new_sheet("T")
+    book.set_cell_contents("T", "A1", "=S!B1 + SUM(S!A1:A100)")
+    cells = book.sheets["s"].cells
+    assert dict.__len__(cells) == 4 and cells.numbers[1].count == 98
+
+    book.rename_sheet("S", "R")
+    cells = book.sheets["r"].cells
+    assert dict.__len__(cells) == 4 and cells.numbers[1].count == 98
+    assert book.get_cell_contents("R", "B1") == "=A1 + R!A2"
+    assert book.get_cell_value("R", "B2") == 5050
+    assert book.get_cell_value("T", "A1") == 5053
+
+    book.del_sheet("R")
+    assert dict.__len__(cells) == 4 and cells.numbers[1].count == 98
+    assert is_error(book.get_cell_value("T", "A1"), CellErrorType.BAD_NAME)
+
+
+def test_aggregates_of_number_columns():
+    '''SUM, AVERAGE, MIN and MAX of numbers are worked out from the columns,
+       with the same results as going through each value'''
+    from sheets import functions
+    book = Workbook()
+    book.new_sheet("S")
+    numbers = [str(row % 7 + 1) for row in range(1, 301)]
+    numbers[8] = "2.25"
+    book.set_cells_contents("S", {"A%d" % row: numbers[row - 1] for row in range(1, 301)})
+    book.set_cells_contents("S", {"B1": "-0", "B3": "0.00",
+        "C1": "99999999999999999.9", "C2": "-99999999999999999.99"})
+    total = sum(decimal.Decimal(number) for number in numbers)
+    def value(formula):
+        book.set_cell_contents("S", "E1", formula)
+        return book.get_cell_value("S", "E1")
+
+    # The values are not gone through one by one
+    combine = functions.combine_args_into_list
+    functions.combine_args_into_list = None
+    try:
+        assert str(value("=SUM(A1:A300)")) == str(total)
+        assert str(value("=SUM(A1:C300, 1)")) == str(total + decimal.Decimal("0.91"))
+        assert value("=AVERAGE(A1:A301)") == total / 301
+        assert value("=MIN(A1:A300)") == 1 and value("=MAX(A1:A300, 3)") == 7
+        # Empty cells count as 0, and the first of equal values is kept
+        assert value("=MAX(B1:B5)") == 0 and str(value("=MIN(B1:B3)")) == "-0"
+        assert value("=MIN(A1:A301)") in (None, 0)
+        assert value("=SUM(D1:D9)") == 0 and value("=MIN(D1:D9)") == 0
+    finally:
+        functions.combine_args_into_list = combine
+
+    # Other values are
+    book.set_cell_contents("S", "A10", "'4")
+    assert value("=SUM(A1:A300)") == total
+    assert isinstance(value("=AVERAGE(D1:D9)"), CellError)
+    book.set_cell_contents("S", "A10", "=1/0")
+    assert isinstance(value("=MIN(A1:A300)"), CellError)
+
+
+def test_range_totals_kept_up_to_date():
+    '''Large ranges read by aggregates keep their totals, and update them
+       with the cells that change instead of adding up the range again'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A%d" % row: str(row) for row in range(1, 1201)})
+    book.set_cells_contents("S", {"C1": "=SUM(A1:A1200)", "C2": "=MIN(A1:A1200)",
+        "C3": "=MAX(A1:A1200)", "C4": "=AVERAGE(A1:A1200)"})
+    cells = book.sheets["s"].cells
+    assert len(cells.totals) == 1
+    totals = list(cells.totals.values())[0]
+    def values():
+        return [str(book.get_cell_value("S", "C%d" % row)) for row in range(1, 5)]
+    assert values() == ["720600", "1", "1200", "600.5"]
+
+    book.set_cell_contents("S", "A5", "2.25")
+    book.set_cell_contents("S", "A7", "=A5 * 1000")
+    assert values() == ["722840.25", "1", "2250", "602.366875"]
+    assert list(cells.totals.values()) == [totals]
+    # The sum has as many places as the numbers still in the range, and
+    # empty cells count as 0 in MIN
+    book.set_cell_contents("S", "A5", "5")
+    book.set_cell_contents("S", "A1", None)
+    assert values() == ["725592", "None", "5000", "604.66"]
+    book.set_cell_contents("S", "A2", "-1")
+    book.set_cell_contents("S", "A3", "-1.0")
+    assert values() == ["725585", "-1", "5000", "604.6541666666666666666666667"]
+
+    # Text can not be added up, so the range is gone through again
+    book.set_cell_contents("S", "A9", "nine")
+    assert not cells.totals
+    assert isinstance(book.get_cell_value("S", "C1"), CellError)
+    book.set_cell_contents("S", "A9", "9")
+    assert len(cells.totals) == 1 and values()[0] == "725585"
+
+
+def test_running_totals_use_column_sums():
+    '''Running totals and sliding windows are added up from Fenwick trees of
+       their columns, which follow the changes of the column'''
+    from sheets.column_sums import FenwickTree
+    tree = FenwickTree([3, 1, 4, 1, 5, 9, 2, 6])
+    assert tree.sum(0, 8) == 31 and tree.sum(2, 5) == 10
+    tree.add(3, 10)
+    assert tree.sum(3, 4) == 11 and tree.prefix(4) == 19
+
+    book = Workbook()
+    book.new_sheet("S")
+    count = 300
+    numbers = [decimal.Decimal(row % 13) / 4 for row in range(1, count + 1)]
+    book.set_cells_contents("S", {"A%d" % row: str(numbers[row - 1])
+        for row in range(1, count + 1)})
+    book.set_cells_contents("S", {"B%d" % row: "=SUM($A$1:A%d)" % row
+        for row in range(1, count + 1)})
+    book.set_cells_contents("S", {"C%d" % row: "=AVERAGE(A%d:A%d)" % (row, row + 99)
+        for row in range(1, 101)})
+    cells = book.sheets["s"].cells
+    assert list(cells.sums) == [1]
+    def check():
+        for row in range(1, count + 1):
+            assert str(book.get_cell_value("S", "B%d" % row)) == str(sum(numbers[:row]))
+        assert book.get_cell_value("S", "C7") == sum(numbers[6:106]) / 100
+
+    check()
+    book.set_cell_contents("S", "A1", "100")
+    numbers[0] = decimal.Decimal(100)
+    book.set_cell_contents("S", "A50", "-0.125")
+    numbers[49] = decimal.Decimal("-0.125")
+    check()
+    # The range consumers of a cell are found without checking the ranges
+    # of other columns
+    assert book.range_index.consumers("s", (2, 5)) == []
+    assert len(book.range_index.consumers("s", (1, 5))) == count - 4 + 5
+
+    book.set_cell_contents("S", "A60", "text")
+    assert isinstance(book.get_cell_value("S", "B60"), CellError)
+    assert book.get_cell_value("S", "B59") == sum(numbers[:59])
+
+
+def test_column_sums_of_formula_in_its_range():
+    '''A formula reading a tall range that holds it leaves the column sums
+       with the values of the column'''
+    book = Workbook()
+    book.new_sheet("S")
+    book.set_cells_contents("S", {"A%d" % row: str(row) for row in range(1, 201)})
+    book.set_cell_contents("S", "A100", "=SUM(A1:A200)")
+    assert is_error(book.get_cell_value("S", "A100"), CellErrorType.CIRCULAR_REFERENCE)
+    sums = book.sheets["s"].cells.sums[1]
+    assert sums.others.sum(100, 101) == 1
+
+    book.set_cell_contents("S", "A100", "100")
+    assert sums.others.sum(0, 201) == 0
+    assert sums.totals(1, 200) is not None
+    book.set_cell_contents("S", "B1", "=SUM(A1:A200)")
+    assert book.get_cell_value("S", "B1") == 200 * 201 // 2
+
+
+def test_lookup_index():
+    '''VLOOKUP and HLOOKUP find the last match through an index of the first
+       column (or row), shared by the lookups into it and dropped when one
+       of its values changes'''
+    book = Workbook()
+    book.new_sheet("T")
+    book.new_sheet("S")
+    book.set_cells_contents("T", {"A%d" % row: str(row % 50) for row in range(1, 501)})
+    book.set_cells_contents("T", {"B%d" % row: "v%d" % row for row in range(1, 501)})
+    book.set_cells_contents("T", {"A3": "text", "A4": "TRUE", "C1": "text", "D1": "1"})
+    book.set_cells_contents("S", {"A%d" % row: "=VLOOKUP(%d, T!A1:B500, 2)" % row
+        for row in range(1, 51)})
+    book.set_cells_contents("S", {"B1": '=VLOOKUP("text", T!A1:B500, 2)',
+        "B2": "=VLOOKUP(1, T!A1:A500, 1)", "B3": "=HLOOKUP(1, T!A1:C2, 2)",
+        "B4": '=VLOOKUP("TEXT", T!A1:B500, 2)', "B5": "=VLOOKUP(1, T!A1:C500, 3)"})
+    cells = book.sheets["t"].cells
+    assert len(cells.lookups) == 2
+    assert book.get_cell_value("S", "A1") == "v451"
+    assert book.get_cell_value("S", "A49") == "v499"
+    assert isinstance(book.get_cell_value("S", "A50"), CellError)
+    assert book.get_cell_value("S", "B1") == "v3"
+    assert book.get_cell_value("S", "B2") == 1 and book.get_cell_value("S", "B3") == 2
+    assert isinstance(book.get_cell_value("S", "B4"), CellError)
+    assert book.get_cell_value("S", "B5") is None
+
+    # A change in the first column drops its index
+    book.set_cell_contents("T", "A500", "1")
+    assert book.get_cell_value("S", "A1") == "v500"
+    book.set_cell_contents("T", "B7", "changed")
+    book.set_cell_contents("T", "A7", "50")
+    assert book.get_cell_value("S", "A50") == "changed"
+    book.sort_region("T", "A1", "B500", [-1])
+    assert book.get_cell_value("S", "A50") == "changed"
+    assert book.get_cell_value("S", "A1") == "v500"